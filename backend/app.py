@@ -3,13 +3,32 @@ DH-Commerce Backend API - Complete with Email System
 """
 
 import os
+import io
+import csv
+import gzip
 import json
+import math
+import time
+import random
+import heapq
+import itertools
+import atexit
+import sqlite3
 import smtplib
-from datetime import datetime, timedelta
+import threading
+import urllib.request
+import urllib.error
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import wraps
+from html import escape as html_escape
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from flask import Flask, request, jsonify
+import click
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Conditional imports to fix colored lines
 try:
@@ -24,6 +43,24 @@ except ImportError:
     firestore = None
     auth = None
 
+try:
+    from google.auth import jwt as google_jwt
+    from google.auth import exceptions as google_auth_exceptions
+    GOOGLE_AUTH_AVAILABLE = True
+except ImportError:
+    print("⚠️ google-auth not installed. Firebase ID tokens cannot be verified.")
+    GOOGLE_AUTH_AVAILABLE = False
+    google_jwt = None
+    google_auth_exceptions = None
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    print("⚠️ NumPy not installed. Nutrition analytics disabled.")
+    NUMPY_AVAILABLE = False
+    np = None
+
 try:
     from dotenv import load_dotenv
     load_dotenv()  # Load environment variables
@@ -46,6 +83,11 @@ except ImportError:
 # INITIALIZE APP
 # ============================================
 app = Flask(__name__)
+# Render's proxy appends the real client address to X-Forwarded-For; trust
+# only that many hops so clients can't choose their own address
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 CORS(app, resources={
     r"/api/*": {
         "origins": [
@@ -74,6 +116,7 @@ if SCHEDULER_AVAILABLE:
 print("🚀 Initializing DH-Commerce Backend...")
 
 db = None  # Firestore database
+FIREBASE_PROJECT_ID = os.environ.get('FIREBASE_PROJECT_ID')
 
 try:
     if FIREBASE_AVAILABLE:
@@ -81,6 +124,7 @@ try:
         if os.path.exists('serviceAccountKey.json'):
             cred = credentials.Certificate('serviceAccountKey.json')
             firebase_admin.initialize_app(cred)
+            FIREBASE_PROJECT_ID = FIREBASE_PROJECT_ID or cred.project_id
             db = firestore.client()
             print("✅ Firebase initialized successfully")
         else:
@@ -93,11 +137,966 @@ except Exception as e:
     print(f"❌ Firebase error: {e}")
     db = None
 
+# ============================================
+# FIRESTORE HELPERS
+# ============================================
+
+FIRESTORE_PAGE_SIZE = int(os.environ.get('FIRESTORE_PAGE_SIZE', 500))
+
+
+def stream_documents(query, page_size=FIRESTORE_PAGE_SIZE, start_after_id=None):
+    """Yield documents from a query page by page, ordered by document id.
+
+    Only one page is held in memory at a time, so this is safe to use on
+    collections of any size. Pass ``start_after_id`` to resume a scan.
+    """
+    query = query.order_by('__name__')
+    last_id = start_after_id
+
+    while True:
+        page_query = query.limit(page_size)
+        if last_id:
+            page_query = page_query.start_after({'__name__': last_id})
+
+        docs = list(page_query.stream())
+        for doc in docs:
+            yield doc
+
+        if len(docs) < page_size:
+            return
+        last_id = docs[-1].id
+
+
+def as_datetime(value):
+    """Convert a Firestore timestamp, ISO string or YYYY-MM-DD date to a naive UTC datetime"""
+    if value is None:
+        return None
+
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(dt_timezone.utc).replace(tzinfo=None)
+        return value
+
+    if isinstance(value, str):
+        try:
+            return as_datetime(datetime.fromisoformat(value))
+        except ValueError:
+            return None
+
+    return None
+
+
+def json_default(value):
+    """JSON serializer for values Firestore returns that json can't handle"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, 'path'):  # DocumentReference
+        return value.path
+    return str(value)
+
+# ============================================
+# CACHING
+# ============================================
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ``ttl`` seconds"""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+# Food listings change rarely and are read on every page load
+FOODS_CACHE_TTL = int(os.environ.get('FOODS_CACHE_TTL', 60))
+foods_cache = TTLCache(maxsize=32, ttl=FOODS_CACHE_TTL)
+
+
+food_doc_cache = TTLCache(maxsize=2048, ttl=FOODS_CACHE_TTL)
+
+
+def invalidate_food_caches():
+    """Drop cached food listings after foods are added, changed or removed"""
+    foods_cache.clear()
+    food_doc_cache.clear()
+
+
+def get_food(food_id):
+    """Read one food document (or None), cached briefly"""
+    if not food_id or food_id == 'all':
+        return None
+    if foods_replica.enabled and foods_replica.is_fresh():
+        return foods_replica.get(food_id)
+    food = food_doc_cache.get(food_id)
+    if food is None:
+        food_doc = db.collection('foods').document(food_id).get()
+        food = food_doc.to_dict() if food_doc.exists else {}
+        food_doc_cache.set(food_id, food)
+    return food or None
+
+# ============================================
+# METRICS
+# ============================================
+
+
+class Metrics:
+    """In-process counters and gauges, exposed at /api/metrics"""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+
+
+metrics = Metrics()
+
+# ============================================
+# SNAPSHOT LISTENERS
+# ============================================
+
+SNAPSHOT_LISTENERS_ENABLED = os.environ.get('SNAPSHOT_LISTENERS_ENABLED', 'true').lower() != 'false'
+
+
+class CollectionWatcher:
+    """One Firestore on_snapshot listener per collection, fanned out to handlers.
+
+    Handlers are called as handler(change_type, doc_id, data, initial) where
+    change_type is ADDED, MODIFIED or REMOVED. ``initial`` is True for the
+    documents delivered by the first snapshot after (re)starting, which is
+    preceded by a RESET call so handlers can drop what they had and
+    followed by a CURRENT call once the local copy is complete.
+    """
+
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self.handlers = []
+        self.last_event_at = None
+        self._watch = None
+        self._initial = True
+        self._lock = threading.Lock()
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    @property
+    def active(self):
+        return self._watch is not None and getattr(self._watch, 'is_active', True)
+
+    def start(self):
+        if not db or not self.handlers:
+            return
+        with self._lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+            self._initial = True
+            self._dispatch('RESET', None, None)
+            self._watch = db.collection(self.collection_name).on_snapshot(self._on_snapshot)
+            print(f"👂 Listening for changes to {self.collection_name}")
+
+    def stop(self):
+        with self._lock:
+            if self._watch is not None:
+                self._watch.unsubscribe()
+                self._watch = None
+
+    def _on_snapshot(self, snapshot, changes, read_time):
+        initial, self._initial = self._initial, False
+        for change in changes:
+            doc = change.document
+            data = doc.to_dict() if change.type.name != 'REMOVED' else None
+            self._dispatch(change.type.name, doc.id, data, initial)
+        if initial:
+            self._dispatch('CURRENT', None, None)
+        self.last_event_at = time.time()
+        metrics.incr(f'listener.{self.collection_name}.changes', len(changes))
+
+    def _dispatch(self, change_type, doc_id, data, initial=True):
+        for handler in self.handlers:
+            try:
+                handler(change_type, doc_id, data, initial)
+            except Exception as e:
+                print(f"❌ Error handling {self.collection_name} change: {e}")
+
+
+collection_watchers = {}
+
+
+def watch_collection(collection_name, handler):
+    """Register a handler for changes to a collection"""
+    watcher = collection_watchers.get(collection_name)
+    if watcher is None:
+        watcher = collection_watchers[collection_name] = CollectionWatcher(collection_name)
+    watcher.add_handler(handler)
+    return watcher
+
+
+def start_collection_watchers():
+    if not SNAPSHOT_LISTENERS_ENABLED:
+        return
+    for watcher in collection_watchers.values():
+        try:
+            watcher.start()
+        except Exception as e:
+            print(f"❌ Could not listen to {watcher.collection_name}: {e}")
+
+
+def check_collection_watchers():
+    """Restart listeners whose stream has died"""
+    if not SNAPSHOT_LISTENERS_ENABLED:
+        return
+    for watcher in collection_watchers.values():
+        if not watcher.active:
+            print(f"⚠️ Listener for {watcher.collection_name} is down, restarting")
+            try:
+                watcher.start()
+            except Exception as e:
+                print(f"❌ Could not listen to {watcher.collection_name}: {e}")
+
+# ============================================
+# READ REPLICA (hot collections held in memory)
+# ============================================
+
+REPLICA_ENABLED = os.environ.get('REPLICA_ENABLED', 'false').lower() == 'true'
+# Serve replicas from a JSON file (see `flask replica-snapshot`) when
+# Firestore isn't connected, e.g. for local development without credentials.
+# Ignored otherwise: a seeded replica never sees writes, so the scheduler
+# jobs would keep acting on the same stale documents.
+REPLICA_SEED_PATH = os.environ.get('REPLICA_SEED_PATH')
+REPLICA_MAX_DOCS = int(os.environ.get('REPLICA_MAX_DOCS', 50000))
+
+
+class CollectionReplica:
+    """In-memory copy of (part of) a collection, kept current by its listener.
+
+    Only documents ``keep`` accepts are held, trimmed to ``fields`` when
+    given. Once the listener has delivered its first snapshot the copy is
+    complete, so lookups - misses included - are answered from memory.
+    While the listener is down, still loading or over ``max_docs``,
+    lookups fall back to Firestore.
+    """
+
+    def __init__(self, name, collection_name, fields=None, keep=None, max_docs=REPLICA_MAX_DOCS):
+        self.name = name
+        self.collection_name = collection_name
+        self.fields = fields
+        self.keep = keep
+        self.max_docs = max_docs
+        self.docs = {}
+        self.watcher = None
+        self.seeded = False
+        self._synced = False
+        self._overflowed = False
+        self._was_fresh = False
+        self._stale_since = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.seeded or self.watcher is not None
+
+    def start(self):
+        """Follow the collection through its shared listener"""
+        self.watcher = watch_collection(self.collection_name, self._on_change)
+
+    def seed(self, docs):
+        """Serve a fixed set of documents without Firestore"""
+        with self._lock:
+            self.docs.clear()
+            self._overflowed = False
+            for doc_id, data in docs.items():
+                self._store(doc_id, data)
+            self.seeded = True
+
+    def _keeps(self, data):
+        return data is not None and (self.keep is None or self.keep(data))
+
+    def _store(self, doc_id, data):
+        if not self._keeps(data):
+            self.docs.pop(doc_id, None)
+            return
+        if doc_id not in self.docs and len(self.docs) >= self.max_docs:
+            if not self._overflowed:
+                print(f"⚠️ {self.name} replica passed {self.max_docs} documents, using Firestore instead")
+                self._overflowed = True
+            return
+        if self.fields is not None:
+            data = {field: data[field] for field in self.fields if field in data}
+        self.docs[doc_id] = data
+
+    def _on_change(self, change_type, doc_id, data, initial):
+        with self._lock:
+            if change_type == 'RESET':
+                self.docs.clear()
+                self._synced = False
+                self._overflowed = False
+            elif change_type == 'CURRENT':
+                self._synced = True
+            else:
+                self._store(doc_id, data)
+
+    def is_fresh(self):
+        """True when the in-memory copy can be trusted"""
+        if self.seeded:
+            return True
+        fresh = (self._synced and not self._overflowed and
+                 self.watcher is not None and self.watcher.active)
+        if self._was_fresh and not fresh:
+            self._stale_since = time.time()
+        self._was_fresh = fresh
+        return fresh
+
+    def _use_memory(self):
+        if not self.enabled:
+            return False
+        fresh = self.is_fresh()
+        metrics.incr(f'replica.{self.name}.{"hits" if fresh else "fallbacks"}')
+        return fresh
+
+    def get(self, doc_id):
+        """Document data, or None if it doesn't exist (or isn't kept)"""
+        if not doc_id:
+            return None
+        if self._use_memory():
+            data = self.docs.get(doc_id)
+            return dict(data) if data is not None else None
+        if not db:
+            return None
+        doc = db.collection(self.collection_name).document(doc_id).get()
+        data = doc.to_dict() if doc.exists else None
+        return data if self._keeps(data) else None
+
+    def find(self, match=None, query=None):
+        """(id, data) pairs for kept documents that satisfy ``match``.
+
+        ``query`` is the Firestore query to stream when falling back; it
+        should select at least the documents ``match`` does.
+        """
+        if self._use_memory():
+            with self._lock:
+                items = list(self.docs.items())
+            return [(doc_id, dict(data)) for doc_id, data in items if match is None or match(data)]
+        if not db:
+            return []
+        results = []
+        for doc in (query or db.collection(self.collection_name)).stream():
+            data = doc.to_dict()
+            if self._keeps(data) and (match is None or match(data)):
+                results.append((doc.id, data))
+        return results
+
+    def update_gauges(self):
+        fresh = self.is_fresh()
+        last_event_at = self.watcher.last_event_at if self.watcher else None
+        prefix = f'replica.{self.name}'
+        metrics.set_gauge(f'{prefix}.docs', len(self.docs))
+        metrics.set_gauge(f'{prefix}.fresh', int(fresh))
+        metrics.set_gauge(f'{prefix}.stale_seconds', 0 if fresh else round(time.time() - self._stale_since, 1))
+        metrics.set_gauge(f'{prefix}.seconds_since_change',
+                          round(time.time() - last_event_at, 1) if last_event_at else None)
+
+
+def is_live_transaction(trans):
+    """Open offers, pending requests and accepted trades still due a reminder or rating"""
+    status = trans.get('status')
+    return status in ('pending', 'pending_request') or (status == 'accepted' and not trans.get('ratingSent'))
+
+
+foods_replica = CollectionReplica('foods', 'foods')
+users_replica = CollectionReplica('users', 'users', fields=('fullName', 'username', 'email'))
+live_transactions_replica = CollectionReplica('live_transactions', 'transactions', keep=is_live_transaction)
+replicas = (foods_replica, users_replica, live_transactions_replica)
+
+
+def update_replica_gauges():
+    for replica in replicas:
+        if replica.enabled:
+            replica.update_gauges()
+
+
+def load_replica_seed(path):
+    """Seed every replica from a {collection: {id: data}} JSON file"""
+    with open(path) as f:
+        seed = json.load(f)
+    for replica in replicas:
+        replica.seed(seed.get(replica.collection_name, {}))
+    print(f"✅ Replicas seeded from {path}: " +
+          ', '.join(f"{replica.name} {len(replica.docs)}" for replica in replicas))
+
+
+if REPLICA_SEED_PATH and db:
+    print("⚠️ Firestore is connected, ignoring REPLICA_SEED_PATH")
+
+if REPLICA_SEED_PATH and not db:
+    try:
+        load_replica_seed(REPLICA_SEED_PATH)
+    except Exception as e:
+        print(f"❌ Could not seed replicas from {REPLICA_SEED_PATH}: {e}")
+elif REPLICA_ENABLED:
+    for replica in replicas:
+        replica.start()
+
+
+@app.cli.command('replica-snapshot')
+@click.option('--out', default='replica-seed.json', help='File to write')
+def replica_snapshot_command(out):
+    """Write what the replicas would hold to a JSON file for REPLICA_SEED_PATH"""
+    if not db:
+        print("❌ Database not connected")
+        return
+
+    seed = {}
+    for replica in replicas:
+        docs = seed.setdefault(replica.collection_name, {})
+        for doc in stream_documents(db.collection(replica.collection_name)):
+            data = doc.to_dict()
+            if replica._keeps(data):
+                if replica.fields is not None:
+                    data = {field: data[field] for field in replica.fields if field in data}
+                docs[doc.id] = data
+
+    with open(out, 'w') as f:
+        json.dump(seed, f, default=json_default)
+    print(f"✅ Wrote {sum(len(docs) for docs in seed.values())} documents to {out}")
+
+# ============================================
+# AUTHENTICATION (Firebase ID tokens)
+# ============================================
+
+FIREBASE_CERTS_URL = ('https://www.googleapis.com/robot/v1/metadata/x509/'
+                      'securetoken@system.gserviceaccount.com')
+VERIFIED_TOKEN_CACHE_SIZE = int(os.environ.get('VERIFIED_TOKEN_CACHE_SIZE', 4096))
+ADMIN_CACHE_TTL = int(os.environ.get('ADMIN_CACHE_TTL', 60))
+# Optional shared secret for scripts; the old hard-coded key is no longer accepted
+ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY')
+
+
+class InvalidTokenError(ValueError):
+    """Raised when a Firebase ID token fails verification"""
+
+
+def _fetch_firebase_certs(url=FIREBASE_CERTS_URL):
+    """Download Google's signing certificates and how long they may be cached"""
+    with urllib.request.urlopen(url, timeout=10) as response:
+        certs = json.loads(response.read().decode('utf-8'))
+        max_age = 0
+        for directive in response.headers.get('Cache-Control', '').split(','):
+            name, _, value = directive.strip().partition('=')
+            if name == 'max-age' and value.isdigit():
+                max_age = int(value)
+        return certs, max_age
+
+
+class FirebaseTokenVerifier:
+    """Verifies Firebase ID tokens locally.
+
+    Google's public certificates are cached for as long as their
+    Cache-Control max-age allows, and tokens that already passed
+    verification are kept in a bounded LRU until they expire, so a
+    verified request costs no network round trip.
+    """
+
+    def __init__(self, project_id, fetch_certs=_fetch_firebase_certs,
+                 cache_size=VERIFIED_TOKEN_CACHE_SIZE):
+        self.project_id = project_id
+        self.fetch_certs = fetch_certs
+        self.verified = TTLCache(maxsize=cache_size, ttl=3600)
+        self._certs = {}
+        self._certs_expire_at = 0
+        self._certs_fetched_at = 0
+        self._lock = threading.Lock()
+
+    def set_certs(self, certs, max_age=3600):
+        """Install signing certificates directly (used offline and in tests)"""
+        with self._lock:
+            self._certs = dict(certs)
+            self._certs_fetched_at = time.time()
+            self._certs_expire_at = self._certs_fetched_at + max_age
+
+    def _get_certs(self, key_id):
+        with self._lock:
+            now = time.time()
+            stale = now >= self._certs_expire_at
+            # Keys rotate; refetch for an unknown kid, but at most once a minute
+            unknown_key = key_id not in self._certs and now - self._certs_fetched_at > 60
+            if (stale or unknown_key) and self.fetch_certs:
+                try:
+                    certs, max_age = self.fetch_certs()
+                    self._certs = certs
+                    self._certs_expire_at = now + max_age
+                except Exception as e:
+                    if not self._certs:
+                        raise InvalidTokenError(f'Could not fetch signing certificates: {e}')
+                    # Keep using the certificates we have and retry shortly
+                    print(f"⚠️ Could not refresh Firebase certificates: {e}")
+                    self._certs_expire_at = now + 60
+                self._certs_fetched_at = now
+            return self._certs
+
+    def verify(self, token):
+        """Return the token's claims, raising InvalidTokenError if it is not valid"""
+        claims = self.verified.get(token)
+        if claims is not None:
+            return claims
+
+        if not GOOGLE_AUTH_AVAILABLE:
+            raise InvalidTokenError('Token verification is not available')
+        if not self.project_id:
+            raise InvalidTokenError('Firebase project id is not configured')
+
+        try:
+            header = google_jwt.decode_header(token)
+            if header.get('alg') != 'RS256':
+                raise InvalidTokenError('Unexpected token algorithm')
+
+            certs = self._get_certs(header.get('kid'))
+            claims = google_jwt.decode(token, certs=certs, audience=self.project_id,
+                                       clock_skew_in_seconds=10)
+        except InvalidTokenError:
+            raise
+        except (ValueError, google_auth_exceptions.GoogleAuthError) as e:
+            raise InvalidTokenError(f'Invalid token: {e}')
+
+        if claims.get('iss') != f'https://securetoken.google.com/{self.project_id}':
+            raise InvalidTokenError('Invalid token issuer')
+        if not claims.get('sub') or len(claims['sub']) > 128:
+            raise InvalidTokenError('Invalid token subject')
+
+        claims['uid'] = claims['sub']
+        remaining = claims.get('exp', 0) - time.time()
+        if remaining > 0:
+            self.verified.set(token, claims, ttl=remaining)
+        return claims
+
+
+token_verifier = FirebaseTokenVerifier(FIREBASE_PROJECT_ID)
+admin_status_cache = TTLCache(maxsize=4096, ttl=ADMIN_CACHE_TTL)
+
+
+def lookup_is_admin(user_id):
+    """Read a user's isAdmin flag, cached for a short time"""
+    is_admin = admin_status_cache.get(user_id)
+    if is_admin is None:
+        is_admin = False
+        if db:
+            user_doc = db.collection('users').document(user_id).get()
+            if user_doc.exists:
+                is_admin = bool(user_doc.to_dict().get('isAdmin', False))
+        admin_status_cache.set(user_id, is_admin)
+    return is_admin
+
+
+def get_request_claims():
+    """Verified Firebase claims for the current request, or None"""
+    if 'auth_claims' not in g:
+        g.auth_claims = None
+        header = request.headers.get('Authorization', '')
+        if header.startswith('Bearer '):
+            try:
+                g.auth_claims = token_verifier.verify(header[len('Bearer '):].strip())
+            except InvalidTokenError as e:
+                print(f"⚠️ Rejected ID token: {e}")
+    return g.auth_claims
+
+
+def get_request_user_id():
+    """uid of the signed-in user making the request, or None"""
+    claims = get_request_claims()
+    return claims['uid'] if claims else None
+
+
+def is_admin_request():
+    """Check admin authentication for the current request"""
+    if ADMIN_API_KEY and request.headers.get('Authorization') == ADMIN_API_KEY:
+        return True
+
+    claims = get_request_claims()
+    if not claims:
+        return False
+    return bool(claims.get('admin')) or lookup_is_admin(claims['uid'])
+
+
+def require_auth(f):
+    """Reject requests without a valid Firebase ID token"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not get_request_claims():
+            return jsonify({'error': 'Unauthorized'}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+# ============================================
+# RATE LIMITING (token buckets)
+# ============================================
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() != 'false'
+# Share buckets between gunicorn workers by pointing this at a SQLite file
+RATE_LIMIT_SQLITE_PATH = os.environ.get('RATE_LIMIT_SQLITE_PATH')
+RATE_LIMIT_SWEEP_SECONDS = 600
+
+# "<requests>/<second|minute|hour|day>" per user (or per IP when signed out)
+RATE_LIMITS = {
+    'send_welcome_email': '5/hour',
+    'send_trade_request_email': '30/hour',
+    'send_trade_accepted_email': '30/hour',
+    'test_email': '5/hour',
+    'rate_transaction': '20/hour',
+    'admin_foods': '120/minute',
+    'admin_foods_bulk': '10/hour',
+    'admin_announce': '10/hour',
+    'notify': '60/hour',
+    'send_trade_declined_email': '30/hour',
+    # Signed-out routes are keyed by IP, and a whole school shares one NAT address
+    'resolve_users': '600/minute',
+    'username_login': '600/minute',
+    'username_password_reset': '120/hour',
+    # Per username, whatever the address, to stop password guessing and reset spam
+    'username_login:username': '10/hour',
+    'username_password_reset:username': '3/hour'
+}
+RATE_LIMITS.update(json.loads(os.environ.get('RATE_LIMITS', '{}')))
+
+_RATE_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_rate_limit(limit):
+    """Turn '30/hour' into (capacity, tokens refilled per second)"""
+    count, _, period = limit.partition('/')
+    count = int(count)
+    return count, count / _RATE_PERIODS[period.strip()]
+
+
+def _refill(tokens, updated_at, now, capacity, rate):
+    return min(capacity, tokens + (now - updated_at) * rate)
+
+
+class TokenBucketLimiter:
+    """Token buckets kept in this process's memory"""
+
+    def __init__(self, max_buckets=100000):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, rate, cost=1):
+        """Take ``cost`` tokens; returns (allowed, seconds until allowed)"""
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            tokens = _refill(tokens, updated_at, now, capacity, rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+
+class SqliteTokenBucketLimiter:
+    """Token buckets in a SQLite file so every worker process sees the same counts"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._last_sweep = 0
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS rate_buckets '
+                         '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def consume(self, key, capacity, rate, cost=1):
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated_at FROM rate_buckets WHERE key = ?',
+                               (key,)).fetchone()
+            tokens = _refill(*(row or (capacity, now)), now, capacity, rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            conn.execute('INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) '
+                         'VALUES (?, ?, ?)', (key, tokens, now))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        if now - self._last_sweep > RATE_LIMIT_SWEEP_SECONDS:
+            self._last_sweep = now
+            self.sweep(now)
+
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+    def sweep(self, now=None):
+        """Delete buckets that have refilled completely, which behave like missing ones"""
+        now = now or time.time()
+        # Untouched for the longest refill period means full, whatever the limit
+        longest = max((capacity / rate for capacity, rate in map(parse_rate_limit, RATE_LIMITS.values())),
+                      default=0)
+        deleted = self._connect().execute('DELETE FROM rate_buckets WHERE updated_at < ?',
+                                          (now - longest,)).rowcount
+        if deleted:
+            metrics.incr('rate_limit.buckets_swept', deleted)
+        return deleted
+
+
+rate_limiter = (SqliteTokenBucketLimiter(RATE_LIMIT_SQLITE_PATH) if RATE_LIMIT_SQLITE_PATH
+                else TokenBucketLimiter())
+
+
+def get_client_ip():
+    """Client address as seen by Render's proxy (see TRUSTED_PROXY_HOPS)"""
+    return request.remote_addr or 'unknown'
+
+
+def check_rate_limit(name, subject):
+    """Take a token from RATE_LIMITS[name] for subject; returns a 429 response or None"""
+    limit = RATE_LIMITS.get(name)
+    if not RATE_LIMIT_ENABLED or not limit:
+        return None
+
+    capacity, rate = parse_rate_limit(limit)
+    allowed, retry_after = rate_limiter.consume(f'{name}:{subject}', capacity, rate)
+    if allowed:
+        metrics.incr(f'rate_limit.allowed.{name}')
+        return None
+
+    metrics.incr(f'rate_limit.limited.{name}')
+    response = jsonify({
+        'error': 'Too many requests',
+        'retryAfter': math.ceil(retry_after)
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response
+
+
+def rate_limited(methods=None):
+    """Apply the route's RATE_LIMITS entry per user id (or client IP)"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if methods and request.method not in methods:
+                return f(*args, **kwargs)
+
+            user_id = get_request_user_id()
+            limited = check_rate_limit(f.__name__, 'user:' + user_id if user_id else 'ip:' + get_client_ip())
+            if limited:
+                return limited
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+# ============================================
+# REQUEST PROFILING (opt-in)
+# ============================================
+
+# Hooks are only registered when this is on, so a disabled profiler costs nothing
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+# Also profile 1 in N requests without the header (0 = header only)
+PROFILE_SAMPLE_EVERY = int(os.environ.get('PROFILE_SAMPLE_EVERY', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 100))
+PROFILE_HEADER = 'X-Profile'
+
+# Where time goes, by the path of the file the code lives in. Each category
+# should cover whole packages, or time spent in an unlisted module between
+# two listed ones is counted twice.
+PROFILE_CATEGORIES = {
+    'firestore': ('/google/', '/grpc/', '/proto/'),
+    # smtplib's cumulative time includes its own socket and TLS work; socket and
+    # ssl are left out so other HTTPS calls aren't counted as SMTP
+    'smtp': ('/smtplib.py',),
+    'rendering': ('/json/', '/jinja2/', '/email/')
+}
+
+
+def profile_category(filename):
+    for category, markers in PROFILE_CATEGORIES.items():
+        if any(marker in filename for marker in markers):
+            return category
+    return None
+
+
+def summarize_profile(stats, top=20):
+    """Total time, time per category and the most expensive functions.
+
+    A category's time is the cumulative time of calls into it from code
+    in no category, so time belongs to the outermost category: JSON parsed
+    by the Firestore client is Firestore time, not rendering time too.
+    """
+    by_category = dict.fromkeys(PROFILE_CATEGORIES, 0.0)
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        category = profile_category(func[0])
+        if not category:
+            continue
+        for caller, (_, _, _, cumulative) in callers.items():
+            if profile_category(caller[0]) is None:
+                by_category[category] += cumulative
+
+    functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+    return {
+        'totalSeconds': round(stats.total_tt, 6),
+        'categories': {category: round(seconds, 6) for category, seconds in by_category.items()},
+        'topFunctions': [{'function': f"{filename}:{lineno}({name})", 'calls': calls,
+                          'ownSeconds': round(own, 6), 'cumulativeSeconds': round(cumulative, 6)}
+                         for (filename, lineno, name), (_, calls, own, cumulative, _) in functions]
+    }
+
+
+def _prune_profiles():
+    """Keep only the newest PROFILE_MAX_FILES profiles"""
+    profiles = sorted((entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith('.prof')),
+                      key=lambda entry: entry.stat().st_mtime)
+    for entry in profiles[:max(0, len(profiles) - PROFILE_MAX_FILES)]:
+        for path in (entry.path, entry.path[:-len('.prof')] + '.json'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+if PROFILING_ENABLED:
+    import cProfile
+    import pstats
+
+    # cProfile can only run one profiler per process at a time
+    _profile_lock = threading.Lock()
+    _profile_counter = itertools.count(1)
+
+    @app.before_request
+    def start_request_profile():
+        sampled = PROFILE_SAMPLE_EVERY and next(_profile_counter) % PROFILE_SAMPLE_EVERY == 0
+        if not sampled and not (request.headers.get(PROFILE_HEADER) and is_admin_request()):
+            return
+        if not _profile_lock.acquire(blocking=False):
+            return
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+    @app.after_request
+    def save_request_profile(response):
+        profiler = g.get('profiler')
+        if profiler is None:
+            return response
+        profiler.disable()
+
+        try:
+            profile_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{request.endpoint or 'unknown'}"
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, profile_id)
+            profiler.dump_stats(path + '.prof')
+
+            summary = summarize_profile(pstats.Stats(profiler))
+            summary.update({'method': request.method, 'path': request.path,
+                            'status': response.status_code})
+            with open(path + '.json', 'w') as f:
+                json.dump(summary, f, indent=2)
+            _prune_profiles()
+
+            metrics.incr('profile.requests')
+            response.headers['X-Profile-Id'] = profile_id
+            print(f"🔬 Profiled {request.method} {request.path}: {summary['totalSeconds'] * 1000:.1f} ms "
+                  f"({', '.join(f'{k} {v * 1000:.1f} ms' for k, v in summary['categories'].items())})")
+        except Exception as e:
+            print(f"❌ Error saving request profile: {e}")
+
+        return response
+
+    @app.teardown_request
+    def stop_request_profile(exc):
+        # after_request is skipped when an exception propagates; teardown isn't
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            _profile_lock.release()
+
 # ============================================
 # EMAIL FUNCTIONS
 # ============================================
 
 
+def build_email_message(to_email, subject, html_content):
+    """MIME message with our From header and an HTML body"""
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = subject
+    msg['From'] = f"DH-Commerce <{EMAIL_USER}>"
+    msg['To'] = to_email
+
+    # Create HTML version
+    html_part = MIMEText(html_content, 'html')
+    msg.attach(html_part)
+    return msg
+
+
+def open_smtp_connection():
+    """Connected and logged-in SMTP client; use it as a context manager"""
+    server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT)
+    try:
+        if EMAIL_USE_TLS:
+            server.starttls()
+        server.login(EMAIL_USER, EMAIL_PASS)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
 def send_email(to_email, subject, html_content):
     """Send email using SMTP"""
     try:
@@ -109,25 +1108,11 @@ def send_email(to_email, subject, html_content):
             print("⚠️ Email credentials not set. Skipping email.")
             return False
 
-        # Create message
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = subject
-        msg['From'] = f"DH-Commerce <{EMAIL_USER}>"
-        msg['To'] = to_email
-
-        # Create HTML version
-        html_part = MIMEText(html_content, 'html')
-        msg.attach(html_part)
+        msg = build_email_message(to_email, subject, html_content)
 
         print("📧 Connecting to SMTP server...")
         # Send email
-        with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT) as server:
-            print("📧 Connection successful")
-            if EMAIL_USE_TLS:
-                print("📧 Starting TLS...")
-                server.starttls()
-            print("📧 Logging in...")
-            server.login(EMAIL_USER, EMAIL_PASS)
+        with open_smtp_connection() as server:
             print("📧 Sending email...")
             server.send_message(msg)
 
@@ -139,8 +1124,165 @@ def send_email(to_email, subject, html_content):
         print(f"❌ Error details: {type(e).__name__}: {e}")
         return False
 
+# ============================================
+# NOTIFICATION DEDUPLICATION & COALESCING
+# ============================================
+
+NOTIFICATION_DEDUP_TTL = int(os.environ.get('NOTIFICATION_DEDUP_TTL', 24 * 3600))
+NOTIFICATION_DEDUP_SIZE = int(os.environ.get('NOTIFICATION_DEDUP_SIZE', 10000))
+# Seconds to hold notifications for the same recipient; 0 sends immediately
+EMAIL_COALESCE_WINDOW = float(os.environ.get('EMAIL_COALESCE_WINDOW', 0))
+
+
+class IdempotencyStore:
+    """Remembers the response for each idempotency key for a bounded time.
+
+    The first request with a key claims it; concurrent repeats wait for that
+    request to finish and then replay its response instead of resending.
+    """
+
+    def __init__(self, maxsize=NOTIFICATION_DEDUP_SIZE, ttl=NOTIFICATION_DEDUP_TTL):
+        self.results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._in_flight = {}
+        self._forgotten = set()
+        self._lock = threading.Lock()
+
+    def claim(self, key, wait=30):
+        """Return (True, None) if the caller owns the key, else (False, cached result)"""
+        while True:
+            with self._lock:
+                result = self.results.get(key)
+                if result is not None:
+                    return False, result
+                event = self._in_flight.get(key)
+                if event is None:
+                    self._in_flight[key] = threading.Event()
+                    return True, None
+
+            # Someone else is sending this notification right now
+            if not event.wait(wait):
+                return False, None
+
+    def release(self, key, result=None):
+        """Store the result (None means the attempt may be retried) and wake waiters"""
+        with self._lock:
+            if result is not None and key not in self._forgotten:
+                self.results.set(key, result)
+            self._forgotten.discard(key)
+            event = self._in_flight.pop(key, None)
+        if event:
+            event.set()
+
+    def forget(self, key):
+        """Drop a stored result so the next request with the key runs again.
+
+        Used when work that was accepted in the background fails; if the
+        request is still in flight its result is not stored at all.
+        """
+        with self._lock:
+            self.results.pop(key)
+            if key in self._in_flight:
+                self._forgotten.add(key)
+
+
+notification_dedup = IdempotencyStore()
+
+
+def idempotent(event_type=None):
+    """Replay the stored response for repeated notification requests.
+
+    The key comes from the Idempotency-Key header, or is derived from the
+    transaction id in the body. Requests without either are not deduplicated.
+    Without an event_type, the body's event field is used.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if not key:
+                transaction_id = (request.get_json(silent=True) or {}).get('transaction_id')
+                key = transaction_id and f'txn:{transaction_id}'
+            if not key:
+                return f(*args, **kwargs)
+
+            key = f"{event_type or (request.get_json(silent=True) or {}).get('event')}:{key}"
+            owner, result = notification_dedup.claim(key)
+            # Background sends forget the key if they fail (see queue_trade_notification)
+            g.idempotency_key = key
+            if not owner:
+                if result is None:
+                    return jsonify({'error': 'Request with this key is still in progress'}), 409
+                body, status = result
+                response = Response(body, status=status, mimetype='application/json')
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+
+            result = None
+            try:
+                response = app.make_response(f(*args, **kwargs))
+                # Only successes are remembered: the client can retry after an
+                # error or a failed send (200 with success false), and one
+                # caller's rejection is never replayed to another
+                body = response.get_json(silent=True) if response.is_json else None
+                failed = isinstance(body, dict) and body.get('success') is False
+                if response.status_code < 400 and not failed:
+                    result = (response.get_data(), response.status_code)
+                return response
+            finally:
+                notification_dedup.release(key, result)
+        return decorated
+    return decorator
+
+
+class EmailCoalescer:
+    """Batches emails for the same recipient that arrive within a short window"""
+
+    def __init__(self, window, send=None):
+        self.window = window
+        self.send = send or send_email
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, to_email, subject, html_content):
+        with self._lock:
+            messages = self._pending.get(to_email)
+            if messages is None:
+                messages = self._pending[to_email] = []
+                timer = threading.Timer(self.window, self.flush, args=[to_email])
+                timer.daemon = True
+                timer.start()
+            messages.append((subject, html_content))
+
+    def flush(self, to_email):
+        with self._lock:
+            messages = self._pending.pop(to_email, [])
+        if not messages:
+            return False
+        if len(messages) == 1:
+            return self.send(to_email, *messages[0])
+
+        subject = f"You have {len(messages)} updates from DH-Commerce"
+        html_content = '<hr>'.join(html for _, html in messages)
+        return self.send(to_email, subject, html_content)
+
+
+email_coalescer = EmailCoalescer(EMAIL_COALESCE_WINDOW)
+
+
+def deliver_notification(to_email, subject, html_content, coalesce=True):
+    """Send a notification now, or queue it to be coalesced with others.
+
+    Returns a dict suitable for the endpoint's JSON response.
+    """
+    if coalesce and email_coalescer.window > 0:
+        email_coalescer.add(to_email, subject, html_content)
+        return {'success': True, 'queued': True}
+
+    return {'success': send_email(to_email, subject, html_content)}
+
 
 @app.route('/api/test-email', methods=['GET'])
+@rate_limited()
 def test_email():
     """Test endpoint to verify email is working"""
     try:
@@ -194,12 +1336,11 @@ def check_trade_reminders():
         one_hour_later = now + timedelta(hours=1)
 
         # Find accepted trades happening within next hour
-        transactions_ref = db.collection('transactions')
-        query = transactions_ref.where('status', '==', 'accepted')
-
-        for doc in query.stream():
-            trans = doc.to_dict()
+        accepted = live_transactions_replica.find(
+            match=lambda trans: trans.get('status') == 'accepted',
+            query=db.collection('transactions').where('status', '==', 'accepted'))
 
+        for trans_id, trans in accepted:
             # Parse trade time
             trade_date = trans.get('tradeDate')
             trade_time = trans.get('tradeTime')
@@ -217,24 +1358,14 @@ def check_trade_reminders():
 
                     if buyer_id and seller_id:
                         # Get user emails
-                        buyer_ref = db.collection('users').document(buyer_id)
-                        seller_ref = db.collection('users').document(seller_id)
-
-                        buyer_doc = buyer_ref.get()
-                        seller_doc = seller_ref.get()
-
-                        if buyer_doc.exists and seller_doc.exists:
-                            buyer_data = buyer_doc.to_dict()
-                            seller_data = seller_doc.to_dict()
+                        buyer_data = users_replica.get(buyer_id)
+                        seller_data = users_replica.get(seller_id)
 
+                        if buyer_data and seller_data:
                             # Get food details
-                            food_ref = db.collection('foods').document(
-                                trans.get('offeredFoodId'))
-                            food_doc = food_ref.get()
-
-                            if food_doc.exists:
-                                food_data = food_doc.to_dict()
+                            food_data = get_food(trans.get('offeredFoodId'))
 
+                            if food_data:
                                 # Send reminder to buyer
                                 send_email(
                                     buyer_data.get('email'),
@@ -263,7 +1394,7 @@ def check_trade_reminders():
                                 )
 
                                 # Mark reminder as sent
-                                doc.reference.update({'reminderSent': True})
+                                db.collection('transactions').document(trans_id).update({'reminderSent': True})
 
         print("✅ Reminder check completed")
 
@@ -281,12 +1412,11 @@ def check_rating_requests():
         twenty_minutes_ago = now - timedelta(minutes=20)
 
         # Find completed trades 20+ minutes ago
-        transactions_ref = db.collection('transactions')
-        query = transactions_ref.where('status', '==', 'accepted')
-
-        for doc in query.stream():
-            trans = doc.to_dict()
+        accepted = live_transactions_replica.find(
+            match=lambda trans: trans.get('status') == 'accepted',
+            query=db.collection('transactions').where('status', '==', 'accepted'))
 
+        for trans_id, trans in accepted:
             trade_date = trans.get('tradeDate')
             trade_time = trans.get('tradeTime')
 
@@ -302,16 +1432,10 @@ def check_rating_requests():
 
                     if buyer_id and seller_id:
                         # Get user emails
-                        buyer_ref = db.collection('users').document(buyer_id)
-                        seller_ref = db.collection('users').document(seller_id)
-
-                        buyer_doc = buyer_ref.get()
-                        seller_doc = seller_ref.get()
-
-                        if buyer_doc.exists and seller_doc.exists:
-                            buyer_data = buyer_doc.to_dict()
-                            seller_data = seller_doc.to_dict()
+                        buyer_data = users_replica.get(buyer_id)
+                        seller_data = users_replica.get(seller_id)
 
+                        if buyer_data and seller_data:
                             # Send rating request to buyer
                             send_email(
                                 buyer_data.get('email'),
@@ -319,7 +1443,7 @@ def check_rating_requests():
                                 f"""
                                 <h3>How was your trade with {seller_data.get('fullName')}?</h3>
                                 <p>Please rate your experience from 1-5 stars.</p>
-                                <p><a href="https://ict-dh-commerce-project.onrender.com/rate/{doc.id}/buyer">Click here to rate</a></p>
+                                <p><a href="https://ict-dh-commerce-project.onrender.com/rate/{trans_id}/buyer">Click here to rate</a></p>
                                 <p>Your feedback helps build trust in our community!</p>
                                 """
                             )
@@ -331,13 +1455,13 @@ def check_rating_requests():
                                 f"""
                                 <h3>How was your trade with {buyer_data.get('fullName')}?</h3>
                                 <p>Please rate your experience from 1-5 stars.</p>
-                                <p><a href="https://ict-dh-commerce-project.onrender.com/rate/{doc.id}/seller">Click here to rate</a></p>
+                                <p><a href="https://ict-dh-commerce-project.onrender.com/rate/{trans_id}/seller">Click here to rate</a></p>
                                 <p>Your feedback helps build trust in our community!</p>
                                 """
                             )
 
                             # Mark rating as sent
-                            doc.reference.update({'ratingSent': True})
+                            db.collection('transactions').document(trans_id).update({'ratingSent': True})
 
         print("✅ Rating request check completed")
 
@@ -382,73 +1506,25 @@ def health():
         'timestamp': datetime.now().isoformat()
     })
 
-# ============================================
-# EMAIL ENDPOINTS
-# ============================================
-
-
-@app.route('/api/send_welcome_email', methods=['POST'])
-def send_welcome_email():
-    """Send welcome email to new user"""
-    try:
-        data = request.json
-        email = data.get('email')
-        name = data.get('name', 'User')
-        username = data.get('username', '')
-
-        if not email:
-            return jsonify({'error': 'Email required'}), 400
 
-        # Send welcome email
-        success = send_email(
-            email,
-            "Welcome to DH-Commerce!",
-            f"""
-            <h2>Welcome to DH-Commerce, {name}!</h2>
-            <p>You've successfully created your account. Start trading food with your classmates!</p>
-            <p><strong>Your username:</strong> {username}</p>
-            <p><strong>Your email:</strong> {email}</p>
-            <p>Remember our rules:</p>
-            <ul>
-                <li>Barter only - no money exchanges</li>
-                <li>Only school-approved foods</li>
-                <li>Be respectful to all traders</li>
-            </ul>
-            <p>Happy trading!</p>
-            <p><em>The DH-Commerce Team</em></p>
-            """
-        )
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """In-process counters and gauges (admin only)"""
+    if not is_admin_request():
+        return jsonify({'error': 'Unauthorized'}), 401
 
-        if success:
-            return jsonify({'success': True, 'message': 'Welcome email sent'})
-        else:
-            return jsonify({'success': False, 'message': 'Failed to send email'})
+    update_replica_gauges()
+    return jsonify(metrics.snapshot())
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+# ============================================
+# EMAIL ENDPOINTS
+# ============================================
 
+APP_URL = os.environ.get('APP_URL', 'https://ict-dh-commerce-project-1.onrender.com')
 
-@app.route('/api/send_trade_request', methods=['POST'])
-def send_trade_request_email():
-    """Send email when someone requests a trade"""
-    try:
-        data = request.json
-        to_email = data.get('to_email')
-        from_user = data.get('from_user')
-        food_name = data.get('food_name')
-        offer_food = data.get('offer_food')
-        trade_time = data.get('trade_time')
-        trade_date = data.get('trade_date')
-        # Default to localhost
-        app_url = data.get('app_url', 'https://ict-dh-commerce-project-1.onrender.com')
-
-        if not all([to_email, from_user, food_name]):
-            return jsonify({'error': 'Missing required fields'}), 400
 
-        success = send_email(
-            to_email,
-            "New Trade Request - DH Commerce",
-            f"""
+def render_trade_request_email(from_user, food_name, offer_food, trade_time, trade_date, app_url=APP_URL):
+    return "New Trade Request - DH Commerce", f"""
             <html>
             <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
                 <div style="max-width: 600px; margin: 0 auto; padding: 20px; border: 1px solid #ddd; border-radius: 10px;">
@@ -489,73 +1565,239 @@ def send_trade_request_email():
             </body>
             </html>
             """
-        )
 
-        return jsonify({'success': success})
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+def render_trade_accepted_email(from_user, food_name, trade_time, trade_date):
+    return "Trade Accepted!", f"""
+            <h3>Good News!</h3>
+            <p>{from_user} has accepted your trade request.</p>
+            <p><strong>You'll receive:</strong> {food_name}</p>
+            <p><strong>Trade Time:</strong> {trade_time} on {trade_date}</p>
+            <p><strong>Location:</strong> School cafeteria</p>
+            <p>Don't forget to show up on time!</p>
+            """
 
 
-@app.route('/api/send_trade_accepted', methods=['POST'])
-def send_trade_accepted_email():
-    """Send email when trade is accepted"""
+def render_trade_declined_email(from_user, food_name, reason, app_url=APP_URL):
+    return "Trade Request Declined", f"""
+            <h3>Trade Request Declined</h3>
+            <p>{from_user} has declined your trade request for <strong>{food_name}</strong>.</p>
+            <p><strong>Reason:</strong> {reason}</p>
+            <p>There are plenty of other offers - <a href="{app_url}">find another trade on DH-Commerce</a>.</p>
+            """
+
+
+@app.route('/api/send_welcome_email', methods=['POST'])
+@rate_limited()
+def send_welcome_email():
+    """Send welcome email to new user"""
     try:
         data = request.json
-        to_email = data.get('to_email')
-        from_user = data.get('from_user')
-        food_name = data.get('food_name')
-        trade_time = data.get('trade_time')
-        trade_date = data.get('trade_date')
+        email = data.get('email')
+        name = data.get('name', 'User')
+        username = data.get('username', '')
+
+        if not email:
+            return jsonify({'error': 'Email required'}), 400
 
+        # Send welcome email
         success = send_email(
-            to_email,
-            "Trade Accepted!",
+            email,
+            "Welcome to DH-Commerce!",
             f"""
-            <h3>Good News!</h3>
-            <p>{from_user} has accepted your trade request.</p>
-            <p><strong>You'll receive:</strong> {food_name}</p>
-            <p><strong>Trade Time:</strong> {trade_time} on {trade_date}</p>
-            <p><strong>Location:</strong> School cafeteria</p>
-            <p>Don't forget to show up on time!</p>
+            <h2>Welcome to DH-Commerce, {name}!</h2>
+            <p>You've successfully created your account. Start trading food with your classmates!</p>
+            <p><strong>Your username:</strong> {username}</p>
+            <p><strong>Your email:</strong> {email}</p>
+            <p>Remember our rules:</p>
+            <ul>
+                <li>Barter only - no money exchanges</li>
+                <li>Only school-approved foods</li>
+                <li>Be respectful to all traders</li>
+            </ul>
+            <p>Happy trading!</p>
+            <p><em>The DH-Commerce Team</em></p>
             """
         )
 
-        return jsonify({'success': success})
+        if success:
+            return jsonify({'success': True, 'message': 'Welcome email sent'})
+        else:
+            return jsonify({'success': False, 'message': 'Failed to send email'})
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # ============================================
-# RATING ENDPOINT (called from email link)
+# TRADE EVENT NOTIFICATIONS (resolved server-side)
 # ============================================
 
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', 4))
+notification_executor = ThreadPoolExecutor(max_workers=NOTIFY_WORKERS, thread_name_prefix='notify')
 
-@app.route('/rate/<transaction_id>/<role>', methods=['GET', 'POST'])
-def rate_transaction(transaction_id, role):
-    """Handle rating submissions from email links"""
+# event -> (status the transaction must have, who triggers it, who is emailed)
+TRADE_EVENTS = {
+    'trade_request': ('pending_request', 'fromUserId', 'toUserId'),
+    'trade_accepted': ('accepted', 'toUserId', 'fromUserId'),
+    'trade_declined': ('declined', 'toUserId', 'fromUserId')
+}
+
+
+def _deliver_in_background(event, to_email, subject, html_content, idempotency_key=None):
+    success = False
     try:
-        if request.method == 'GET':
-            # Show rating form
-            return f"""
-            <html>
-            <head>
-                <title>Rate Your Trade - DH-Commerce</title>
-                <style>
-                    body {{ font-family: Arial, sans-serif; padding: 40px; max-width: 500px; margin: 0 auto; }}
-                    .container {{ background: #f5f5f5; padding: 30px; border-radius: 10px; }}
-                    select, textarea {{ width: 100%; padding: 10px; margin: 10px 0; }}
-                    button {{ background: #1d3557; color: white; padding: 12px 24px; border: none; border-radius: 5px; cursor: pointer; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <h2>Rate Your Trade Experience</h2>
-                    <form method="POST">
-                        <label>Rating (1-5 stars):</label><br>
-                        <select name="rating">
-                            <option value="5">★★★★★ - Excellent</option>
-                            <option value="4">★★★★☆ - Good</option>
+        result = deliver_notification(to_email, subject, html_content)
+        success = bool(result.get('success'))
+        metrics.incr(f"notify.{event}.{'sent' if success else 'failed'}")
+    except Exception as e:
+        print(f"❌ Error sending {event} notification: {e}")
+    finally:
+        # The 202 was already remembered; let the client's retry send again
+        if not success and idempotency_key:
+            notification_dedup.forget(idempotency_key)
+
+
+def queue_trade_notification(event, transaction_id):
+    """Build a trade event email from Firestore and send it in the background.
+
+    The caller must be the user who triggered the event (or an admin), and
+    the transaction must already be in the event's state. Both users and
+    both foods are fetched in one batched read.
+    """
+    try:
+        if event not in TRADE_EVENTS:
+            return jsonify({'error': f"event must be one of {', '.join(TRADE_EVENTS)}"}), 400
+        if not transaction_id:
+            return jsonify({'error': 'transaction_id required'}), 400
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        trans_doc = db.collection('transactions').document(transaction_id).get()
+        if not trans_doc.exists:
+            return jsonify({'error': 'Transaction not found'}), 404
+        trans = trans_doc.to_dict()
+
+        status, actor_field, recipient_field = TRADE_EVENTS[event]
+        actor_id, recipient_id = trans.get(actor_field), trans.get(recipient_field)
+        if get_request_user_id() != actor_id and not is_admin_request():
+            return jsonify({'error': 'Forbidden'}), 403
+        if trans.get('status') != status or not actor_id or not recipient_id:
+            return jsonify({'error': f'Transaction is not {status}'}), 409
+
+        refs = [db.collection('users').document(actor_id), db.collection('users').document(recipient_id)]
+        for field in ('offeredFoodId', 'requestedFoodId'):
+            if trans.get(field) and trans[field] != 'all':
+                refs.append(db.collection('foods').document(trans[field]))
+        docs = {doc.reference.path: doc.to_dict() for doc in db.get_all(refs) if doc.exists}
+
+        actor = docs.get(f'users/{actor_id}', {})
+        recipient = docs.get(f'users/{recipient_id}', {})
+        if not recipient.get('email'):
+            return jsonify({'error': 'Recipient has no email address'}), 409
+
+        def food_name(field):
+            food = docs.get(f"foods/{trans.get(field)}")
+            return html_escape(food.get('name', '')) if food else 'Any food'
+
+        from_user = html_escape(actor.get('fullName') or actor.get('username') or 'Another student')
+        trade_time = html_escape(str(trans.get('tradeTime', '')))
+        trade_date = html_escape(str(trans.get('tradeDate', '')))
+
+        if event == 'trade_request':
+            subject, html_content = render_trade_request_email(
+                from_user, food_name('requestedFoodId'), food_name('offeredFoodId'), trade_time, trade_date)
+        elif event == 'trade_accepted':
+            subject, html_content = render_trade_accepted_email(
+                from_user, food_name('requestedFoodId'), trade_time, trade_date)
+        else:
+            reason = html_escape(trans.get('declineReason') or 'No reason provided')
+            subject, html_content = render_trade_declined_email(from_user, food_name('requestedFoodId'), reason)
+
+        notification_executor.submit(_deliver_in_background, event, recipient['email'], subject, html_content,
+                                     g.get('idempotency_key'))
+        return jsonify({'success': True, 'queued': True}), 202
+
+    except Exception as e:
+        print(f"❌ Error queuing {event} notification: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/notify', methods=['POST'])
+@require_auth
+@rate_limited()
+@idempotent()
+def notify():
+    """Email the other party about a trade event
+
+    Body: {"event": "trade_request" | "trade_accepted" | "trade_declined",
+    "transaction_id": ...}. Everything else is read from Firestore.
+    """
+    data = request.get_json(silent=True) or {}
+    return queue_trade_notification(data.get('event'), data.get('transaction_id'))
+
+
+# The per-event routes older clients call; they no longer take addresses or names
+
+@app.route('/api/send_trade_request', methods=['POST'])
+@require_auth
+@rate_limited()
+@idempotent('trade_request')
+def send_trade_request_email():
+    """Email the offer's owner about a new trade request"""
+    data = request.get_json(silent=True) or {}
+    return queue_trade_notification('trade_request', data.get('transaction_id'))
+
+
+@app.route('/api/send_trade_accepted', methods=['POST'])
+@require_auth
+@rate_limited()
+@idempotent('trade_accepted')
+def send_trade_accepted_email():
+    """Email the requester that their trade request was accepted"""
+    data = request.get_json(silent=True) or {}
+    return queue_trade_notification('trade_accepted', data.get('transaction_id'))
+
+
+@app.route('/api/send_trade_declined', methods=['POST'])
+@require_auth
+@rate_limited()
+@idempotent('trade_declined')
+def send_trade_declined_email():
+    """Email the requester that their trade request was declined"""
+    data = request.get_json(silent=True) or {}
+    return queue_trade_notification('trade_declined', data.get('transaction_id'))
+
+# ============================================
+# RATING ENDPOINT (called from email link)
+# ============================================
+
+
+@app.route('/rate/<transaction_id>/<role>', methods=['GET', 'POST'])
+@rate_limited(methods=['POST'])
+def rate_transaction(transaction_id, role):
+    """Handle rating submissions from email links"""
+    try:
+        if request.method == 'GET':
+            # Show rating form
+            return f"""
+            <html>
+            <head>
+                <title>Rate Your Trade - DH-Commerce</title>
+                <style>
+                    body {{ font-family: Arial, sans-serif; padding: 40px; max-width: 500px; margin: 0 auto; }}
+                    .container {{ background: #f5f5f5; padding: 30px; border-radius: 10px; }}
+                    select, textarea {{ width: 100%; padding: 10px; margin: 10px 0; }}
+                    button {{ background: #1d3557; color: white; padding: 12px 24px; border: none; border-radius: 5px; cursor: pointer; }}
+                </style>
+            </head>
+            <body>
+                <div class="container">
+                    <h2>Rate Your Trade Experience</h2>
+                    <form method="POST">
+                        <label>Rating (1-5 stars):</label><br>
+                        <select name="rating">
+                            <option value="5">★★★★★ - Excellent</option>
+                            <option value="4">★★★★☆ - Good</option>
                             <option value="3">★★★☆☆ - Average</option>
                             <option value="2">★★☆☆☆ - Poor</option>
                             <option value="1">★☆☆☆☆ - Very Poor</option>
@@ -627,6 +1869,8 @@ def rate_transaction(transaction_id, role):
                     'averageRating': new_average
                 })
 
+            record_rating(rater_user_id, rated_user_id, rating)
+
             return """
             <html>
             <body style="font-family: Arial, sans-serif; padding: 40px; text-align: center;">
@@ -646,19 +1890,51 @@ def rate_transaction(transaction_id, role):
 # ============================================
 
 
+def build_food_data(data):
+    """Validate an incoming food and fill in defaults.
+
+    Raises ValueError with a user-facing message when the food is invalid.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Food must be an object')
+
+    required_fields = ['name', 'calories', 'mealType']
+    for field in required_fields:
+        if field not in data:
+            raise ValueError(f'Missing required field: {field}')
+
+    def as_int(field, default=None):
+        try:
+            return int(data.get(field, default))
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid number for field: {field}')
+
+    # Set default values
+    return {
+        'name': data['name'],
+        'calories': as_int('calories'),
+        'protein': as_int('protein', 0),
+        'carbs': as_int('carbs', 0),
+        'fat': as_int('fat', 0),
+        'mealType': data['mealType'],
+        'availableDate': data.get('availableDate', datetime.now().strftime('%Y-%m-%d')),
+        'availableTime': data.get('availableTime', '12:00'),
+        'allergyWarnings': data.get('allergyWarnings', ['none']),
+        'nutrientsImportance': data.get('nutrientsImportance', 'Provides essential nutrients'),
+        'createdAt': datetime.now().isoformat(),
+        'updatedAt': datetime.now().isoformat()
+    }
+
+
 @app.route('/api/admin/foods', methods=['GET', 'POST', 'PUT', 'DELETE'])
+@rate_limited(methods=['POST', 'PUT', 'DELETE'])
 def admin_foods():
     """Admin endpoint for food management"""
     try:
         if not db:
             return jsonify({'error': 'Database not connected'}), 500
 
-        # Check admin authentication (in production, use Firebase Auth)
-        admin_token = request.headers.get('Authorization')
-        # Simple admin check - in production, verify Firebase token
-        is_admin = admin_token == 'admin-secret-key'  # Change this in production
-
-        if not is_admin:
+        if not is_admin_request():
             return jsonify({'error': 'Unauthorized'}), 401
 
         if request.method == 'GET':
@@ -679,30 +1955,14 @@ def admin_foods():
 
         elif request.method == 'POST':
             # Add new food
-            data = request.json
-            required_fields = ['name', 'calories', 'mealType']
-            for field in required_fields:
-                if field not in data:
-                    return jsonify({'error': f'Missing required field: {field}'}), 400
-
-            # Set default values
-            food_data = {
-                'name': data['name'],
-                'calories': int(data['calories']),
-                'protein': int(data.get('protein', 0)),
-                'carbs': int(data.get('carbs', 0)),
-                'fat': int(data.get('fat', 0)),
-                'mealType': data['mealType'],
-                'availableDate': data.get('availableDate', datetime.now().strftime('%Y-%m-%d')),
-                'availableTime': data.get('availableTime', '12:00'),
-                'allergyWarnings': data.get('allergyWarnings', ['none']),
-                'nutrientsImportance': data.get('nutrientsImportance', 'Provides essential nutrients'),
-                'createdAt': datetime.now().isoformat(),
-                'updatedAt': datetime.now().isoformat()
-            }
+            try:
+                food_data = build_food_data(request.json)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
 
             doc_ref = db.collection('foods').document()
             doc_ref.set(food_data)
+            invalidate_food_caches()
 
             return jsonify({
                 'success': True,
@@ -726,6 +1986,7 @@ def admin_foods():
             update_data['updatedAt'] = datetime.now().isoformat()
 
             doc_ref.update(update_data)
+            invalidate_food_caches()
 
             return jsonify({
                 'success': True,
@@ -744,6 +2005,7 @@ def admin_foods():
                 return jsonify({'error': 'Food not found'}), 404
 
             doc_ref.delete()
+            invalidate_food_caches()
 
             return jsonify({
                 'success': True,
@@ -754,23 +2016,169 @@ def admin_foods():
         return jsonify({'error': str(e)}), 500
 
 
+BULK_BATCH_SIZE = 500  # Firestore's limit on writes per batch
+BULK_IMPORT_WORKERS = int(os.environ.get('BULK_IMPORT_WORKERS', 4))
+
+
+def _food_key(food):
+    """Natural key used to upsert foods: name + availableDate"""
+    return (str(food.get('name', '')).strip().lower(), food.get('availableDate'))
+
+
+def _csv_food_row(row):
+    """Turn a CSV row into the same shape the JSON POST body uses"""
+    food = {key.strip(): value.strip() for key, value in row.items()
+            if key and value is not None and value.strip() != ''}
+    warnings = food.get('allergyWarnings')
+    if warnings is not None:
+        if warnings.startswith('['):
+            food['allergyWarnings'] = json.loads(warnings)
+        else:
+            food['allergyWarnings'] = [w.strip() for w in warnings.split(';') if w.strip()]
+    return food
+
+
+def _iter_uploaded_foods():
+    """Yield foods from a CSV, NDJSON or JSON upload without buffering text files"""
+    upload = request.files.get('file')
+    if upload:
+        stream = upload.stream
+        filename = (upload.filename or '').lower()
+        kind = 'csv' if filename.endswith('.csv') else (
+            'ndjson' if filename.endswith(('.ndjson', '.jsonl')) else 'json')
+    else:
+        stream = request.stream
+        content_type = (request.mimetype or '').lower()
+        kind = 'csv' if 'csv' in content_type else (
+            'ndjson' if 'ndjson' in content_type or 'jsonl' in content_type else 'json')
+
+    if kind == 'csv':
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        for row in csv.DictReader(text):
+            try:
+                yield _csv_food_row(row)
+            except ValueError as e:
+                yield ValueError(f'Invalid allergyWarnings: {e}')
+
+    elif kind == 'ndjson':
+        text = io.TextIOWrapper(stream, encoding='utf-8')
+        for line in text:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield ValueError(f'Invalid JSON: {e}')
+
+    else:
+        data = json.load(stream)
+        if isinstance(data, dict):
+            data = data.get('foods', [])
+        for food in data:
+            yield food
+
+
+def _commit_food_batch(writes):
+    """Commit one batch of (row, doc_ref, food_data, is_update) writes"""
+    batch = db.batch()
+    for _, doc_ref, food_data, is_update in writes:
+        batch.set(doc_ref, food_data, merge=is_update)
+    batch.commit()
+
+
+@app.route('/api/admin/foods/bulk', methods=['POST'])
+@rate_limited()
+def admin_foods_bulk():
+    """Bulk import foods from a CSV, NDJSON or JSON upload (admin only)
+
+    Rows are validated with the same rules as POST /api/admin/foods and
+    upserted by name + availableDate; updates only change the columns the
+    row fills in. Returns a per-row error report.
+    """
+    try:
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        if not is_admin_request():
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        # Existing foods by natural key, so re-importing a menu updates it
+        existing = {}
+        for doc in stream_documents(db.collection('foods').select(['name', 'availableDate'])):
+            existing[_food_key(doc.to_dict() or {})] = doc.id
+
+        errors = []
+        pending = OrderedDict()  # natural key -> write; later rows win
+        row_number = 0
+
+        try:
+            for row_number, row in enumerate(_iter_uploaded_foods(), start=1):
+                try:
+                    if isinstance(row, ValueError):
+                        raise row
+                    food_data = build_food_data(row)
+                except ValueError as e:
+                    errors.append({'row': row_number, 'error': str(e)})
+                    continue
+
+                key = _food_key(food_data)
+                food_id = existing.get(key)
+                if food_id:
+                    # Only what the row sets; defaults must not overwrite stored values
+                    food_data = {field: value for field, value in food_data.items()
+                                 if field in row or field == 'updatedAt'}
+                    if key in pending:
+                        food_data = dict(pending[key][2], **food_data)
+                    pending[key] = (row_number, db.collection('foods').document(food_id), food_data, True)
+                else:
+                    doc_ref = pending[key][1] if key in pending else db.collection('foods').document()
+                    pending[key] = (row_number, doc_ref, food_data, False)
+
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            # Malformed upload - report it against the row we stopped at
+            errors.append({'row': row_number + 1, 'error': f'Could not parse upload: {e}'})
+
+        writes = list(pending.values())
+        batches = [writes[i:i + BULK_BATCH_SIZE] for i in range(0, len(writes), BULK_BATCH_SIZE)]
+
+        written = []
+        with ThreadPoolExecutor(max_workers=BULK_IMPORT_WORKERS) as executor:
+            futures = [(chunk, executor.submit(_commit_food_batch, chunk)) for chunk in batches]
+            for chunk, future in futures:
+                try:
+                    future.result()
+                    written.extend(chunk)
+                except Exception as e:
+                    errors.extend({'row': row, 'error': f'Write failed: {e}'} for row, _, _, _ in chunk)
+
+        if written:
+            invalidate_food_caches()
+
+        errors.sort(key=lambda error: error['row'])
+        updated = sum(1 for write in written if write[3])
+
+        return jsonify({
+            'success': not errors,
+            'rows': row_number,
+            'created': len(written) - updated,
+            'updated': updated,
+            'failed': len(errors),
+            'errors': errors
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/admin/check', methods=['GET'])
 def admin_check():
     """Check if user is admin"""
     try:
-        user_id = request.args.get('userId')
+        # Prefer the signed-in user from the ID token over the query param
+        user_id = get_request_user_id() or request.args.get('userId')
         if not user_id or not db:
             return jsonify({'isAdmin': False})
 
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
-
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            is_admin = user_data.get('isAdmin', False)
-            return jsonify({'isAdmin': is_admin})
-
-        return jsonify({'isAdmin': False})
+        return jsonify({'isAdmin': lookup_is_admin(user_id)})
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -779,23 +2187,37 @@ def admin_check():
 @app.route('/api/foods', methods=['GET'])
 def get_foods():
     try:
+        # Apply filters
+        meal_type = request.args.get('mealType')
+
+        if foods_replica.enabled and foods_replica.is_fresh():
+            foods = [dict(food, id=food_id) for food_id, food in foods_replica.find(
+                match=lambda food: not meal_type or food.get('mealType') == meal_type)]
+            return jsonify({
+                'success': True,
+                'count': len(foods),
+                'foods': foods
+            })
+
         if not db:
             return jsonify({'error': 'Database not connected'}), 500
 
         foods_ref = db.collection('foods')
 
-        # Apply filters
-        meal_type = request.args.get('mealType')
-        if meal_type:
-            foods_ref = foods_ref.where('mealType', '==', meal_type)
+        foods = foods_cache.get(meal_type or '')
+        if foods is None:
+            if meal_type:
+                foods_ref = foods_ref.where('mealType', '==', meal_type)
 
-        docs = foods_ref.stream()
+            docs = foods_ref.stream()
 
-        foods = []
-        for doc in docs:
-            food_data = doc.to_dict()
-            food_data['id'] = doc.id
-            foods.append(food_data)
+            foods = []
+            for doc in docs:
+                food_data = doc.to_dict()
+                food_data['id'] = doc.id
+                foods.append(food_data)
+
+            foods_cache.set(meal_type or '', foods)
 
         return jsonify({
             'success': True,
@@ -871,6 +2293,7 @@ def init_sample_foods():
             batch.set(doc_ref, food)
 
         batch.commit()
+        invalidate_food_caches()
 
         return jsonify({
             'success': True,
@@ -880,18 +2303,437 @@ def init_sample_foods():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ============================================
+# ADMIN EXPORT ENDPOINTS (Reporting)
+# ============================================
+
+EXPORTABLE_COLLECTIONS = ('foods', 'transactions', 'ratings')
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def _export_row(doc, fields):
+    """Flatten a document into the dict that gets exported"""
+    data = doc.to_dict() or {}
+    data['id'] = doc.id
+    if fields:
+        data = {field: data.get(field) for field in fields}
+    return data
+
+
+def _csv_value(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=json_default)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+@app.route('/api/admin/export/<collection_name>', methods=['GET'])
+def admin_export(collection_name):
+    """Stream a collection as NDJSON or CSV (admin only)
+
+    Query params:
+        format    - ndjson (default) or csv
+        fields    - comma separated list of fields to include
+        since     - only documents with dateField >= this date (YYYY-MM-DD or ISO)
+        until     - only documents with dateField < this date
+        dateField - field used for the date range (default createdAt)
+    """
+    try:
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        if not is_admin_request():
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        if collection_name not in EXPORTABLE_COLLECTIONS:
+            return jsonify({'error': f'Cannot export collection: {collection_name}'}), 400
+
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({'error': f'Unsupported format: {export_format}'}), 400
+
+        fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+        date_field = request.args.get('dateField', 'createdAt')
+
+        since = as_datetime(request.args.get('since'))
+        until = as_datetime(request.args.get('until'))
+        if request.args.get('since') and not since:
+            return jsonify({'error': 'Invalid since date'}), 400
+        if request.args.get('until') and not until:
+            return jsonify({'error': 'Invalid until date'}), 400
+
+        def matching_rows():
+            # createdAt is a Firestore timestamp for documents written by the
+            # frontend and an ISO string for documents written here, so the
+            # date range is applied while paging instead of in the query.
+            for doc in stream_documents(db.collection(collection_name)):
+                if since or until:
+                    value = as_datetime((doc.to_dict() or {}).get(date_field))
+                    if value is None:
+                        continue
+                    if since and value < since:
+                        continue
+                    if until and value >= until:
+                        continue
+                yield _export_row(doc, fields)
+
+        def generate_ndjson():
+            for row in matching_rows():
+                yield json.dumps(row, default=json_default) + '\n'
+
+        def generate_csv():
+            buffer = io.StringIO()
+            writer = None
+            for row in matching_rows():
+                if writer is None:
+                    # Without a field list the first document decides the columns
+                    writer = csv.DictWriter(buffer, fieldnames=fields or list(row.keys()),
+                                            extrasaction='ignore')
+                    writer.writeheader()
+                writer.writerow({key: _csv_value(value) for key, value in row.items()})
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+
+            if writer is None and fields:
+                csv.writer(buffer).writerow(fields)
+                yield buffer.getvalue()
+
+        generator = generate_csv if export_format == 'csv' else generate_ndjson
+        extension = 'csv' if export_format == 'csv' else 'ndjson'
+        filename = f"{collection_name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{extension}"
+
+        return Response(
+            stream_with_context(generator()),
+            mimetype=EXPORT_FORMATS[export_format],
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        )
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# ============================================
+# ANNOUNCEMENTS (bulk email to all users)
+# ============================================
+
+ANNOUNCE_CHUNK_SIZE = int(os.environ.get('ANNOUNCE_CHUNK_SIZE', 50))      # emails per SMTP connection
+ANNOUNCE_WORKERS = int(os.environ.get('ANNOUNCE_WORKERS', 4))             # connections open at once
+ANNOUNCE_RATE_PER_SECOND = float(os.environ.get('ANNOUNCE_RATE_PER_SECOND', 10))
+# A job whose heartbeat is older than this is treated as interrupted
+ANNOUNCE_STALE_SECONDS = 120
+ANNOUNCE_FAILED_SAMPLE = 50
+
+# One job at a time; each job fans out to its own bounded pool of senders
+announcement_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='announce')
+announce_throttle = TokenBucketLimiter(max_buckets=1)
+_running_announcements = set()
+_running_announcements_lock = threading.Lock()
+
+
+def render_announcement(subject, message):
+    """Wrap an admin's plain-text message in the shared announcement template"""
+    paragraphs = ''.join(f"<p>{html_escape(part).replace(chr(10), '<br>')}</p>"
+                         for part in message.strip().split('\n\n') if part.strip())
+    return f"""
+            <h2>{html_escape(subject)}</h2>
+            {paragraphs}
+            <p><em>The DH-Commerce Team</em></p>
+            """
+
+
+def normalize_email(value):
+    email = (value or '').strip().lower()
+    return email if '@' in email else None
+
+
+def _throttle_announcements():
+    while True:
+        allowed, wait = announce_throttle.consume('announce', ANNOUNCE_RATE_PER_SECOND,
+                                                  ANNOUNCE_RATE_PER_SECOND)
+        if allowed:
+            return
+        time.sleep(wait)
+
+
+def send_bulk_email(recipients, subject, html_content):
+    """Send one message to each recipient over a single SMTP connection.
+
+    Returns (sent, failed addresses). If the connection drops, the rest of
+    the chunk is reported as failed rather than retried.
+    """
+    if not EMAIL_USER or not EMAIL_PASS:
+        print("⚠️ Email credentials not set. Skipping announcement chunk.")
+        return 0, list(recipients)
+
+    sent = done = 0
+    failed = []
+    try:
+        with open_smtp_connection() as server:
+            for to_email in recipients:
+                _throttle_announcements()
+                try:
+                    server.send_message(build_email_message(to_email, subject, html_content))
+                    sent += 1
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError):
+                    failed.append(to_email)
+                done += 1
+    except Exception as e:
+        print(f"❌ Announcement chunk aborted after {done} emails: {type(e).__name__}: {e}")
+        failed.extend(recipients[done:])
+
+    return sent, failed
+
+
+def _emails_before(cursor):
+    """Addresses of users already covered by a job, so a resumed job skips them"""
+    seen = set()
+    if cursor is None:
+        return seen
+    for doc in stream_documents(db.collection('users').select(['email'])):
+        if doc.id > cursor:
+            break
+        email = normalize_email((doc.to_dict() or {}).get('email'))
+        if email:
+            seen.add(email)
+    return seen
+
+
+def run_announcement(job_id):
+    """Send an announcement job from its saved cursor to the end.
+
+    Users are read in pages and addresses deduplicated. Up to
+    ANNOUNCE_WORKERS chunks are sent at once; the cursor is saved after
+    each round, so an interruption resends at most one round.
+    """
+    with _running_announcements_lock:
+        if job_id in _running_announcements:
+            return
+        _running_announcements.add(job_id)
+
+    job_ref = db.collection('announcements').document(job_id)
+    try:
+        job = job_ref.get().to_dict()
+        if job.get('status') == 'completed':
+            return
+        cursor = job.get('cursor')
+        counts = {key: job.get(key, 0) for key in ('sent', 'failed', 'duplicates', 'skipped')}
+        failed_sample = list(job.get('failedSample', []))
+        seen = _emails_before(cursor)
+        job_ref.update({'status': 'running', 'heartbeatAt': datetime.now().isoformat()})
+        print(f"📣 Announcement {job_id} running from {cursor or 'the start'}")
+
+        def send_round(chunks, last_id):
+            results = senders.map(lambda chunk: send_bulk_email(chunk, job['subject'], job['html']), chunks)
+            for sent, failed in results:
+                counts['sent'] += sent
+                counts['failed'] += len(failed)
+                failed_sample.extend(failed[:ANNOUNCE_FAILED_SAMPLE - len(failed_sample)])
+                metrics.incr('announce.sent', sent)
+                metrics.incr('announce.failed', len(failed))
+            job_ref.update(dict(counts, cursor=last_id, failedSample=failed_sample,
+                                heartbeatAt=datetime.now().isoformat()))
+
+        with ThreadPoolExecutor(max_workers=ANNOUNCE_WORKERS) as senders:
+            chunks, chunk = [], []
+            last_id = cursor
+            users = db.collection('users').select(['email'])
+            for doc in stream_documents(users, start_after_id=cursor):
+                last_id = doc.id
+                email = normalize_email((doc.to_dict() or {}).get('email'))
+                if not email:
+                    counts['skipped'] += 1
+                elif email in seen:
+                    counts['duplicates'] += 1
+                else:
+                    seen.add(email)
+                    chunk.append(email)
+
+                if len(chunk) == ANNOUNCE_CHUNK_SIZE:
+                    chunks.append(chunk)
+                    chunk = []
+                if len(chunks) == ANNOUNCE_WORKERS:
+                    send_round(chunks, last_id)
+                    chunks = []
+
+            if chunk:
+                chunks.append(chunk)
+            send_round(chunks, last_id)
+
+        job_ref.update({'status': 'completed', 'completedAt': datetime.now().isoformat()})
+        print(f"✅ Announcement {job_id} done: {counts['sent']} sent, {counts['failed']} failed")
+
+    except Exception as e:
+        print(f"❌ Announcement {job_id} stopped: {e}")
+        try:
+            job_ref.update({'status': 'failed', 'error': str(e)})
+        except Exception:
+            pass
+
+    finally:
+        with _running_announcements_lock:
+            _running_announcements.discard(job_id)
+
+
+def _announcement_status(job_id, job):
+    job = {key: value for key, value in job.items() if key != 'html'}
+    job['id'] = job_id
+    return job
+
+
+@app.route('/api/admin/announce', methods=['POST'])
+@rate_limited()
+def admin_announce():
+    """Start emailing an announcement to every user (admin only)
+
+    Body: {"subject": ..., "message": ...}. Returns 202 with the job id;
+    poll GET /api/admin/announce/<job_id> for progress.
+    """
+    try:
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        if not is_admin_request():
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        data = request.json or {}
+        subject = (data.get('subject') or '').strip()
+        message = data.get('message') or ''
+        if not subject or not message.strip():
+            return jsonify({'error': 'subject and message are required'}), 400
+
+        job_ref = db.collection('announcements').document()
+        job_ref.set({
+            'subject': subject,
+            'html': render_announcement(subject, message),
+            'status': 'queued',
+            'cursor': None,
+            'sent': 0,
+            'failed': 0,
+            'duplicates': 0,
+            'skipped': 0,
+            'failedSample': [],
+            'createdBy': get_request_user_id(),
+            'createdAt': datetime.now().isoformat()
+        })
+        announcement_executor.submit(run_announcement, job_ref.id)
+
+        return jsonify({
+            'success': True,
+            'jobId': job_ref.id,
+            'status': 'queued',
+            'statusUrl': f'/api/admin/announce/{job_ref.id}'
+        }), 202
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/admin/announce/<job_id>', methods=['GET'])
+def announcement_status(job_id):
+    """Progress of an announcement job (admin only)"""
+    try:
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        if not is_admin_request():
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        doc = db.collection('announcements').document(job_id).get()
+        if not doc.exists:
+            return jsonify({'error': 'Announcement not found'}), 404
+
+        return jsonify({'success': True, 'job': _announcement_status(job_id, doc.to_dict())})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/admin/announce/<job_id>/resume', methods=['POST'])
+def resume_announcement(job_id):
+    """Continue an interrupted or failed announcement from its saved cursor (admin only)"""
+    try:
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        if not is_admin_request():
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        doc = db.collection('announcements').document(job_id).get()
+        if not doc.exists:
+            return jsonify({'error': 'Announcement not found'}), 404
+
+        job = doc.to_dict()
+        if job.get('status') == 'completed':
+            return jsonify({'error': 'Announcement already completed'}), 409
+
+        # Another worker process may still be sending it
+        heartbeat = as_datetime(job.get('heartbeatAt'))
+        if job.get('status') == 'running' and heartbeat and \
+                (datetime.now() - heartbeat).total_seconds() < ANNOUNCE_STALE_SECONDS:
+            return jsonify({'error': 'Announcement is still running'}), 409
+
+        announcement_executor.submit(run_announcement, job_id)
+        return jsonify({'success': True, 'job': _announcement_status(job_id, job)}), 202
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # ============================================
 # TRADE HISTORY ENDPOINT
 # ============================================
 
 
+def add_trade_details(trade_history):
+    """Attach food details and the other user's name to each trade"""
+    for trade in trade_history:
+        # Get offered food
+        offered_food = get_food(trade.get('offeredFoodId'))
+        if offered_food:
+            trade['offeredFood'] = offered_food
+
+        # Get requested food ('all' has no document)
+        requested_food = get_food(trade.get('requestedFoodId'))
+        if requested_food:
+            trade['requestedFood'] = requested_food
+
+        # Get user details (public offers have no other user yet)
+        other_user_id = trade.get('toUserId') if trade['direction'] == 'sent' else trade.get('fromUserId')
+        other_user = users_replica.get(other_user_id)
+        if other_user:
+            trade['otherUser'] = other_user.get('fullName')
+
+
 @app.route('/api/trade-history/<user_id>', methods=['GET'])
+@require_auth
 def get_trade_history(user_id):
-    """Get complete trade history for a user"""
+    """Get complete trade history for a user
+
+    Pass archived=true (with optional cursor and pageSize) to page through
+    trades that have been moved to the archive.
+    """
     try:
         if not db:
             return jsonify({'error': 'Database not connected'}), 500
 
+        if get_request_user_id() != user_id and not is_admin_request():
+            return jsonify({'error': 'Forbidden'}), 403
+
+        if request.args.get('archived', '').lower() in ('1', 'true', 'yes'):
+            page_size = min(ARCHIVE_PAGE_SIZE_MAX, max(1, request.args.get('pageSize', 50, type=int)))
+            trades, next_cursor = read_archived_trades(user_id, request.args.get('cursor'), page_size)
+            add_trade_details(trades)
+            return jsonify({
+                'success': True,
+                'archived': True,
+                'count': len(trades),
+                'history': trades,
+                'nextCursor': next_cursor
+            })
+
         # Get all transactions where user is involved
         sent_transactions = db.collection('transactions').where(
             'fromUserId', '==', user_id).stream()
@@ -917,33 +2759,7 @@ def get_trade_history(user_id):
         # Sort by date (newest first)
         trade_history.sort(key=lambda x: x.get('createdAt', ''), reverse=True)
 
-        # Get food details for each trade
-        for trade in trade_history:
-            # Get offered food
-            if 'offeredFoodId' in trade:
-                food_doc = db.collection('foods').document(
-                    trade['offeredFoodId']).get()
-                if food_doc.exists:
-                    trade['offeredFood'] = food_doc.to_dict()
-
-            # Get requested food
-            if 'requestedFoodId' in trade and trade['requestedFoodId'] != 'all':
-                food_doc = db.collection('foods').document(
-                    trade['requestedFoodId']).get()
-                if food_doc.exists:
-                    trade['requestedFood'] = food_doc.to_dict()
-
-            # Get user details
-            if trade['direction'] == 'sent':
-                user_doc = db.collection('users').document(
-                    trade['toUserId']).get()
-                if user_doc.exists:
-                    trade['otherUser'] = user_doc.to_dict().get('fullName')
-            else:
-                user_doc = db.collection('users').document(
-                    trade['fromUserId']).get()
-                if user_doc.exists:
-                    trade['otherUser'] = user_doc.to_dict().get('fullName')
+        add_trade_details(trade_history)
 
         return jsonify({
             'success': True,
@@ -955,6 +2771,1499 @@ def get_trade_history(user_id):
         return jsonify({'error': str(e)}), 500
 
 
+# ============================================
+# PEOPLE DIRECTORY SEARCH
+# ============================================
+
+# Only these fields ever leave the server - never email
+PUBLIC_USER_FIELDS = ('fullName', 'username', 'grade', 'description', 'totalRating',
+                      'ratingCount', 'averageRating', 'tradesCompleted')
+PEOPLE_INDEX_SYNC_MINUTES = int(os.environ.get('PEOPLE_INDEX_SYNC_MINUTES', 10))
+PEOPLE_PAGE_SIZE_MAX = 100
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class PeopleIndex:
+    """In-memory trigram index over users' fullName and username"""
+
+    def __init__(self):
+        self.loaded = False
+        self._people = {}    # uid -> public fields
+        self._terms = {}     # uid -> (lowercase fullName, lowercase username)
+        self._grams = {}     # trigram -> set of uids
+        self._lock = threading.Lock()
+
+    def _unindex(self, user_id):
+        for term in self._terms.pop(user_id, ()):
+            for gram in _trigrams(term):
+                uids = self._grams.get(gram)
+                if uids:
+                    uids.discard(user_id)
+                    if not uids:
+                        del self._grams[gram]
+        self._people.pop(user_id, None)
+
+    def upsert(self, user_id, data):
+        person = {field: data.get(field) for field in PUBLIC_USER_FIELDS}
+        terms = (str(data.get('fullName') or '').lower(), str(data.get('username') or '').lower())
+        with self._lock:
+            self._unindex(user_id)
+            self._people[user_id] = person
+            self._terms[user_id] = terms
+            for term in terms:
+                for gram in _trigrams(term):
+                    self._grams.setdefault(gram, set()).add(user_id)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._unindex(user_id)
+
+    def user_ids(self):
+        with self._lock:
+            return set(self._people)
+
+    def clear(self):
+        with self._lock:
+            self._people.clear()
+            self._terms.clear()
+            self._grams.clear()
+            self.loaded = False
+
+    def _rank(self, query, terms):
+        """Lower is better; None when the user doesn't match"""
+        best = None
+        for term in terms:
+            if term == query:
+                rank = 0
+            elif term.startswith(query):
+                rank = 1
+            elif f' {query}' in term:
+                rank = 2  # start of a later word, e.g. a last name
+            elif query in term:
+                rank = 3
+            else:
+                continue
+            best = rank if best is None else min(best, rank)
+        return best
+
+    def search(self, query, offset=0, limit=20, exclude=None):
+        """Return (total matches, one page of results)"""
+        query = query.strip().lower()
+        with self._lock:
+            if not query:
+                candidates = self._people.keys()
+            elif len(query) < 3:
+                candidates = self._terms.keys()
+            else:
+                # Every trigram of the query must appear in a matching name
+                postings = [self._grams.get(gram, set()) for gram in _trigrams(query)]
+                postings.sort(key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+
+            matches = []
+            for user_id in candidates:
+                if user_id == exclude:
+                    continue
+                rank = self._rank(query, self._terms[user_id]) if query else 0
+                if rank is not None:
+                    matches.append((rank, self._terms[user_id][0], user_id))
+
+            matches.sort()
+            page = [dict(self._people[user_id], id=user_id)
+                    for _, _, user_id in matches[offset:offset + limit]]
+            return len(matches), page
+
+
+people_index = PeopleIndex()
+
+
+def _on_user_change(change_type, user_id, data, initial):
+    if change_type == 'RESET':
+        people_index.clear()
+    elif change_type == 'CURRENT':
+        people_index.loaded = True
+    elif change_type == 'REMOVED':
+        people_index.remove(user_id)
+    else:
+        people_index.upsert(user_id, data)
+
+
+users_watcher = watch_collection('users', _on_user_change)
+
+
+def sync_people_index():
+    """Full reload of public user fields when the snapshot listener isn't running"""
+    if not db or (users_watcher.active and people_index.loaded):
+        return
+
+    try:
+        seen = set()
+        for doc in stream_documents(db.collection('users').select(list(PUBLIC_USER_FIELDS))):
+            people_index.upsert(doc.id, doc.to_dict() or {})
+            seen.add(doc.id)
+        for user_id in people_index.user_ids() - seen:
+            people_index.remove(user_id)
+        people_index.loaded = True
+        print(f"✅ People index synced ({len(seen)} users)")
+
+    except Exception as e:
+        print(f"❌ Error syncing people index: {e}")
+
+
+@app.route('/api/people/search', methods=['GET'])
+@require_auth
+def search_people():
+    """Ranked, paginated search over names and usernames
+
+    Query params: q, page (1-based), pageSize, exclude (user id to leave out)
+    """
+    try:
+        if not people_index.loaded:
+            if not db:
+                return jsonify({'error': 'Database not connected'}), 500
+            sync_people_index()
+
+        query = request.args.get('q', '')
+        page = max(1, request.args.get('page', 1, type=int))
+        page_size = min(PEOPLE_PAGE_SIZE_MAX, max(1, request.args.get('pageSize', 20, type=int)))
+
+        total, people = people_index.search(
+            query,
+            offset=(page - 1) * page_size,
+            limit=page_size,
+            exclude=request.args.get('exclude')
+        )
+
+        return jsonify({
+            'success': True,
+            'query': query,
+            'total': total,
+            'page': page,
+            'pageSize': page_size,
+            'hasMore': page * page_size < total,
+            'people': people
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# ============================================
+# USERNAME RESOLUTION (login & signup)
+# ============================================
+
+USERNAME_CACHE_SIZE = int(os.environ.get('USERNAME_CACHE_SIZE', 10000))
+USERNAME_CACHE_TTL = int(os.environ.get('USERNAME_CACHE_TTL', 300))
+USERNAME_NEGATIVE_TTL = int(os.environ.get('USERNAME_NEGATIVE_TTL', 30))
+RESOLVE_BULK_MAX = 100
+FIRESTORE_IN_LIMIT = 30  # max values in a single 'in' filter
+
+_NOT_FOUND = object()
+username_cache = TTLCache(maxsize=USERNAME_CACHE_SIZE, ttl=USERNAME_CACHE_TTL)
+user_summary_cache = TTLCache(maxsize=USERNAME_CACHE_SIZE, ttl=USERNAME_CACHE_TTL)
+cached_username_by_id = TTLCache(maxsize=USERNAME_CACHE_SIZE, ttl=USERNAME_CACHE_TTL)
+
+
+def _cache_username(username, user_id, data):
+    if user_id is None:
+        username_cache.set(username, _NOT_FOUND, ttl=USERNAME_NEGATIVE_TTL)
+        return None
+
+    user = {'id': user_id, 'email': data.get('email')}
+    username_cache.set(username, user)
+    cached_username_by_id.set(user_id, username)
+    return user
+
+
+def resolve_usernames(usernames):
+    """Map each username to {'id', 'email'} or None, using the cache first.
+
+    For server-side use only; routes must strip the email before replying.
+    """
+    results = {}
+    missing = []
+    for username in usernames:
+        cached = username_cache.get(username)
+        if cached is None:
+            missing.append(username)
+        else:
+            results[username] = None if cached is _NOT_FOUND else cached
+
+    for i in range(0, len(missing), FIRESTORE_IN_LIMIT):
+        chunk = missing[i:i + FIRESTORE_IN_LIMIT]
+        found = {}
+        query = db.collection('users').where('username', 'in', chunk)
+        for doc in query.select(['username', 'email']).stream():
+            data = doc.to_dict() or {}
+            found.setdefault(data.get('username'), (doc.id, data))
+
+        for username in chunk:
+            user_id, data = found.get(username, (None, None))
+            results[username] = _cache_username(username, user_id, data)
+
+    return results
+
+
+def resolve_user_ids(user_ids):
+    """Map each user id to its public display fields or None, in one batched read"""
+    results = {}
+    missing = []
+    for user_id in user_ids:
+        cached = user_summary_cache.get(user_id)
+        if cached is None:
+            missing.append(user_id)
+        else:
+            results[user_id] = None if cached is _NOT_FOUND else cached
+
+    if missing:
+        refs = [db.collection('users').document(user_id) for user_id in missing]
+        for doc in db.get_all(refs, field_paths=['username', 'fullName']):
+            if doc.exists:
+                data = doc.to_dict() or {}
+                summary = {'id': doc.id, 'username': data.get('username'),
+                           'fullName': data.get('fullName')}
+                user_summary_cache.set(doc.id, summary)
+                results[doc.id] = summary
+            else:
+                user_summary_cache.set(doc.id, _NOT_FOUND, ttl=USERNAME_NEGATIVE_TTL)
+                results[doc.id] = None
+
+    return results
+
+
+def _on_user_change_resolution(change_type, user_id, data, initial):
+    """Profile writes invalidate cached lookups, including negative ones"""
+    if change_type == 'RESET':
+        username_cache.clear()
+        user_summary_cache.clear()
+        cached_username_by_id.clear()
+    if change_type in ('RESET', 'CURRENT') or initial:
+        return
+
+    user_summary_cache.pop(user_id)
+    previous_username = cached_username_by_id.pop(user_id)
+    if previous_username:
+        username_cache.pop(previous_username)
+    if data and data.get('username'):
+        username_cache.pop(data['username'])
+
+
+watch_collection('users', _on_user_change_resolution)
+
+
+def _public_username_result(user):
+    """Strip private fields (the account email) before a lookup leaves the server"""
+    return {'id': user['id']} if user else None
+
+
+@app.route('/api/users/resolve', methods=['GET', 'POST'])
+@rate_limited()
+def resolve_users():
+    """Check a username is taken (GET ?username=) or resolve many at once (POST)
+
+    The signed-out GET is the signup availability check and answers only
+    {"exists": true|false}. POST body: {"usernames": [...], "ids": [...]}
+    requires a signed-in user and returns public fields only. Emails never
+    leave the server; username sign-in and resets go through /api/auth/*.
+    """
+    try:
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        if request.method == 'GET':
+            username = request.args.get('username', '').strip()
+            if not username:
+                return jsonify({'error': 'Username required'}), 400
+
+            user = resolve_usernames([username])[username]
+            return jsonify({'success': True, 'username': username, 'exists': bool(user)})
+
+        if not get_request_claims():
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        data = request.get_json(silent=True) or {}
+        usernames = list(dict.fromkeys(str(u).strip() for u in data.get('usernames', []) if u))
+        user_ids = list(dict.fromkeys(str(u) for u in data.get('ids', []) if u))
+        if len(usernames) + len(user_ids) > RESOLVE_BULK_MAX:
+            return jsonify({'error': f'At most {RESOLVE_BULK_MAX} lookups per request'}), 400
+
+        resolved = resolve_usernames(usernames) if usernames else {}
+        return jsonify({
+            'success': True,
+            'usernames': {name: _public_username_result(user) for name, user in resolved.items()},
+            'ids': resolve_user_ids(user_ids) if user_ids else {}
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# ============================================
+# USERNAME SIGN-IN & PASSWORD RESET
+# ============================================
+# The browser only knows the username, so the server looks up the email,
+# checks the password against Firebase Auth and hands back a custom token
+# for signInWithCustomToken(). The email itself is never sent back.
+
+# Same key as apiKey in frontend/config.js
+FIREBASE_WEB_API_KEY = os.environ.get('FIREBASE_WEB_API_KEY')
+IDENTITY_TOOLKIT_URL = 'https://identitytoolkit.googleapis.com/v1/accounts:{}?key={}'
+# Firebase Auth replies that mean "wrong username or password"
+AUTH_REJECTED_ERRORS = ('EMAIL_NOT_FOUND', 'INVALID_PASSWORD', 'INVALID_LOGIN_CREDENTIALS',
+                        'INVALID_EMAIL', 'USER_DISABLED')
+
+
+class AuthRejectedError(ValueError):
+    """Raised when Firebase Auth rejects the supplied credentials"""
+
+
+def _identity_toolkit(method, payload):
+    """POST to the Firebase Auth REST API and return the decoded reply"""
+    if not FIREBASE_WEB_API_KEY:
+        raise RuntimeError('FIREBASE_WEB_API_KEY not configured')
+
+    req = urllib.request.Request(
+        IDENTITY_TOOLKIT_URL.format(method, FIREBASE_WEB_API_KEY),
+        data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read().decode('utf-8'))['error']['message']
+        except Exception:
+            raise e
+        # e.g. "TOO_MANY_ATTEMPTS_TRY_LATER : ..." carries a detail suffix
+        if message.split(' ')[0] in AUTH_REJECTED_ERRORS:
+            raise AuthRejectedError(message)
+        raise RuntimeError(f'Firebase Auth error: {message}')
+
+
+@app.route('/api/auth/login', methods=['POST'])
+@rate_limited()
+def username_login():
+    """Sign in with a username and password, returning a Firebase custom token
+
+    Unknown usernames and wrong passwords get the same reply. Besides the
+    per-IP limit, each username gets a few attempts an hour from anywhere.
+    """
+    try:
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        data = request.get_json(silent=True) or {}
+        username = str(data.get('username', '')).strip()
+        password = data.get('password') or ''
+        if not username or not password:
+            return jsonify({'error': 'Username and password required'}), 400
+
+        limited = check_rate_limit('username_login:username', username.lower())
+        if limited:
+            return limited
+
+        user = resolve_usernames([username])[username]
+        if not user or not user.get('email'):
+            return jsonify({'success': False, 'error': 'Invalid username or password'}), 401
+
+        try:
+            result = _identity_toolkit('signInWithPassword', {
+                'email': user['email'], 'password': password, 'returnSecureToken': False})
+        except AuthRejectedError:
+            return jsonify({'success': False, 'error': 'Invalid username or password'}), 401
+
+        token = auth.create_custom_token(result['localId'])
+        if isinstance(token, bytes):
+            token = token.decode('utf-8')
+        return jsonify({'success': True, 'token': token})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/auth/password-reset', methods=['POST'])
+@rate_limited()
+def username_password_reset():
+    """Email a password reset link to the account behind a username
+
+    Always answers the same way whether or not the username exists.
+    """
+    try:
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        data = request.get_json(silent=True) or {}
+        username = str(data.get('username', '')).strip()
+        if not username:
+            return jsonify({'error': 'Username required'}), 400
+
+        limited = check_rate_limit('username_password_reset:username', username.lower())
+        if limited:
+            return limited
+
+        user = resolve_usernames([username])[username]
+        if user and user.get('email'):
+            try:
+                _identity_toolkit('sendOobCode', {'requestType': 'PASSWORD_RESET',
+                                                  'email': user['email']})
+                print(f"🔑 Password reset sent for {username}")
+            except AuthRejectedError as e:
+                print(f"⚠️ Password reset for {username} rejected: {e}")
+
+        return jsonify({'success': True,
+                        'message': 'If that username exists, a reset link has been sent'})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# ============================================
+# USER STATISTICS (materialized counters)
+# ============================================
+
+# Only one process should apply transaction changes; with several gunicorn
+# workers set USER_STATS_LISTENER=false on all but one.
+USER_STATS_LISTENER = os.environ.get('USER_STATS_LISTENER', 'true').lower() != 'false'
+USER_STATS_FLUSH_SECONDS = int(os.environ.get('USER_STATS_FLUSH_SECONDS', 15))
+USER_STATS_FLUSH_USERS = 400  # flush early before a batch gets too big
+
+# Which counter a transaction contributes to for each user involved
+STATUS_COUNTERS = {
+    'accepted': 'tradesCompleted',
+    'pending_request': 'tradesPending',
+    'declined': 'tradesDeclined',
+    'pending': 'openOffers'
+}
+# Counters for trades still in progress; archived transactions never count towards them
+LIVE_COUNTERS = ('tradesPending', 'openOffers')
+USER_STATS_FIELDS = ('tradesCompleted', 'tradesPending', 'tradesDeclined', 'openOffers',
+                     'ratingsGiven', 'ratingsReceived', 'ratingTotalReceived')
+
+
+def transaction_contributions(trans, archived=False):
+    """Counter increments a transaction in its current state is responsible for"""
+    if not trans:
+        return []
+
+    counter = STATUS_COUNTERS.get(trans.get('status'))
+    if not counter or (archived and counter in LIVE_COUNTERS):
+        return []
+
+    contributions = []
+    for user_id in (trans.get('fromUserId'), trans.get('toUserId')):
+        if not user_id:
+            continue
+        contributions.append((user_id, counter))
+        if counter == 'tradesCompleted':
+            food = get_food(trans.get('offeredFoodId'))
+            if food and food.get('mealType'):
+                contributions.append((user_id, f"tradesByMealType.{food['mealType']}"))
+    return contributions
+
+
+class UserStatsAccumulator:
+    """Collects counter deltas and writes them to userStats in batches.
+
+    The state a transaction was counted in is written back to it as
+    statsCounted in the same batch as its deltas, so a restarted listener
+    can tell what still needs counting. Batches are flushed well below
+    Firestore's write limit, so one flush is normally a single commit.
+    """
+
+    def __init__(self):
+        self._deltas = {}
+        self._counted = {}  # transaction id -> state to store as statsCounted
+        self._lock = threading.Lock()
+        self.markers_ready = False  # set once every transaction carries statsCounted
+
+    def add(self, user_id, field, amount=1):
+        self.apply([(user_id, field, amount)])
+
+    def apply(self, changes, trans_id=None, counted=None):
+        """Add (user_id, field, amount) deltas and the state they bring trans_id to"""
+        with self._lock:
+            for user_id, field, amount in changes:
+                user_deltas = self._deltas.setdefault(user_id, {})
+                user_deltas[field] = user_deltas.get(field, 0) + amount
+            if trans_id:
+                self._counted[trans_id] = counted
+            should_flush = len(self._deltas) + len(self._counted) >= USER_STATS_FLUSH_USERS
+        if should_flush or not scheduler:
+            self.flush()
+
+    def forget(self, trans_id):
+        """Drop the pending marker for a transaction that no longer exists"""
+        with self._lock:
+            self._counted.pop(trans_id, None)
+
+    def discard(self):
+        with self._lock:
+            self._deltas = {}
+            self._counted = {}
+
+    def flush(self):
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+            counted, self._counted = self._counted, {}
+        if not (deltas or counted) or not db:
+            return
+
+        writes = []
+        for user_id, fields in deltas.items():
+            update = {'updatedAt': datetime.now().isoformat()}
+            for field, amount in fields.items():
+                if amount == 0:
+                    continue
+                # Dotted names become nested maps, e.g. tradesByMealType.lunch
+                target = update
+                *parents, leaf = field.split('.')
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                target[leaf] = firestore.Increment(amount)
+            writes.append((db.collection('userStats').document(user_id), update, True))
+        for trans_id, state in counted.items():
+            writes.append((db.collection('transactions').document(trans_id), {'statsCounted': state}, False))
+
+        for i in range(0, len(writes), BULK_BATCH_SIZE):
+            batch = db.batch()
+            for ref, update, merge in writes[i:i + BULK_BATCH_SIZE]:
+                if merge:
+                    batch.set(ref, update, merge=True)
+                else:
+                    batch.update(ref, update)
+            batch.commit()
+        metrics.incr('user_stats.flushed_users', len(deltas))
+
+
+user_stats = UserStatsAccumulator()
+transaction_states = {}  # transaction id -> last seen data needed for deltas
+_TRACKED_TRANSACTION_FIELDS = ('status', 'fromUserId', 'toUserId', 'offeredFoodId')
+
+
+def _user_stats_meta():
+    return db.collection('_meta').document('userStats')
+
+
+def tracked_transaction_state(trans):
+    """The fields of a transaction its counters depend on, as stored in statsCounted"""
+    return {field: (trans or {}).get(field) for field in _TRACKED_TRANSACTION_FIELDS}
+
+
+def is_stats_counted(trans):
+    """Whether the stats listener has counted this transaction's current state"""
+    if not (USER_STATS_LISTENER and SNAPSHOT_LISTENERS_ENABLED):
+        return True
+    return trans.get('statsCounted') == tracked_transaction_state(trans)
+
+
+def record_transaction_change(before, after, trans_id=None):
+    """Apply the counter changes for a transaction moving from before to after"""
+    changes = [(user_id, field, -1) for user_id, field in transaction_contributions(before)]
+    changes += [(user_id, field, 1) for user_id, field in transaction_contributions(after)]
+    user_stats.apply(changes, trans_id, after)
+
+
+def record_rating(rater_user_id, rated_user_id, rating):
+    if rater_user_id:
+        user_stats.add(rater_user_id, 'ratingsGiven')
+    if rated_user_id:
+        user_stats.add(rated_user_id, 'ratingsReceived')
+        user_stats.add(rated_user_id, 'ratingTotalReceived', rating)
+
+
+def _on_transaction_change_stats(change_type, trans_id, data, initial):
+    if change_type == 'RESET':
+        transaction_states.clear()
+        user_stats.markers_ready = _user_stats_meta().get().exists
+        return
+    if change_type == 'CURRENT':
+        if not user_stats.markers_ready:
+            # Every transaction has been marked; from now on markers are trusted
+            user_stats.flush()
+            _user_stats_meta().set({'markersSince': datetime.now().isoformat()})
+            user_stats.markers_ready = True
+        return
+
+    before = transaction_states.pop(trans_id, None)
+    if change_type == 'REMOVED':
+        user_stats.forget(trans_id)
+        # Transactions are only deleted when archived: finished trades stay
+        # counted, anything still counted as in progress stops counting
+        for user_id, field in transaction_contributions(before):
+            if field in LIVE_COUNTERS:
+                user_stats.add(user_id, field, -1)
+        return
+
+    after = tracked_transaction_state(data)
+    transaction_states[trans_id] = after
+    counted = data.get('statsCounted')
+
+    if initial:
+        # Catch up on whatever changed while nobody was listening. Before the
+        # first marked run, existing state is what rebuild-user-stats counted.
+        before = counted if user_stats.markers_ready else after
+
+    if before != after:
+        record_transaction_change(before, after, trans_id)
+    elif counted != after:
+        user_stats.apply([], trans_id, after)
+
+
+if USER_STATS_LISTENER:
+    watch_collection('transactions', _on_transaction_change_stats)
+    # Deltas waiting for the next interval flush would otherwise be lost
+    atexit.register(user_stats.flush)
+
+
+def rebuild_user_stats():
+    """Recompute every userStats document from transactions and ratings"""
+    stats = {}
+
+    def bump(user_id, field, amount=1):
+        user_fields = stats.setdefault(user_id, {})
+        user_fields[field] = user_fields.get(field, 0) + amount
+
+    user_stats.discard()
+    unmarked = []
+    for doc in stream_documents(db.collection('transactions')):
+        trans = doc.to_dict() or {}
+        for user_id, field in transaction_contributions(trans):
+            bump(user_id, field)
+        state = tracked_transaction_state(trans)
+        if trans.get('statsCounted') != state:
+            unmarked.append((doc.reference, state))
+    for _, trans in iter_archived_transactions():
+        for user_id, field in transaction_contributions(trans, archived=True):
+            bump(user_id, field)
+
+    for doc in stream_documents(db.collection('ratings')):
+        rating = doc.to_dict() or {}
+        if rating.get('fromUserId'):
+            bump(rating['fromUserId'], 'ratingsGiven')
+        if rating.get('toUserId'):
+            bump(rating['toUserId'], 'ratingsReceived')
+            bump(rating['toUserId'], 'ratingTotalReceived', rating.get('rating', 0))
+
+    items = list(stats.items())
+    for i in range(0, len(items), BULK_BATCH_SIZE):
+        batch = db.batch()
+        for user_id, fields in items[i:i + BULK_BATCH_SIZE]:
+            document = {field: 0 for field in USER_STATS_FIELDS}
+            document['tradesByMealType'] = {}
+            for field, value in fields.items():
+                if field.startswith('tradesByMealType.'):
+                    document['tradesByMealType'][field.split('.', 1)[1]] = value
+                else:
+                    document[field] = value
+            document['updatedAt'] = datetime.now().isoformat()
+            batch.set(db.collection('userStats').document(user_id), document)
+        batch.commit()
+
+    # What was just counted is what the listener should compare against
+    for i in range(0, len(unmarked), BULK_BATCH_SIZE):
+        batch = db.batch()
+        for ref, state in unmarked[i:i + BULK_BATCH_SIZE]:
+            batch.update(ref, {'statsCounted': state})
+        batch.commit()
+    _user_stats_meta().set({'markersSince': datetime.now().isoformat()})
+    user_stats.markers_ready = True
+
+    return len(items)
+
+
+@app.cli.command('rebuild-user-stats')
+def rebuild_user_stats_command():
+    """Backfill userStats from the full transaction and rating history"""
+    if not db:
+        print("❌ Database not connected")
+        return
+    count = rebuild_user_stats()
+    print(f"✅ Rebuilt stats for {count} users")
+
+
+@app.route('/api/users/<user_id>/stats', methods=['GET'])
+@require_auth
+def get_user_stats(user_id):
+    """Trade and rating counters for a user, in a single document read"""
+    try:
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        stats_doc = db.collection('userStats').document(user_id).get()
+        stats = {field: 0 for field in USER_STATS_FIELDS}
+        stats['tradesByMealType'] = {}
+        if stats_doc.exists:
+            stats.update(stats_doc.to_dict())
+
+        received = stats.get('ratingsReceived', 0)
+        stats['averageRating'] = stats.get('ratingTotalReceived', 0) / received if received else 0
+
+        return jsonify({'success': True, 'userId': user_id, 'stats': stats})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# ============================================
+# BARTER MATCHING (multi-party trade cycles)
+# ============================================
+
+MATCH_MAX_LENGTH = 3
+# Steps allowed per start offer, so one offer full of 'all' matches can't starve the rest
+MATCH_SEARCH_BUDGET = int(os.environ.get('MATCH_SEARCH_BUDGET', 20000))
+MATCH_RESULTS_MAX = 50
+
+
+class BarterGraph:
+    """Open offers as a directed graph.
+
+    An edge runs from offer A to offer B when B gives what A wants (or A
+    accepts 'all'). A cycle through the graph is a set of offers that can
+    all be traded at once: everyone hands over their food and receives the
+    next person's. Offers are indexed by the food they give and the food
+    they want, so cycles through one user's offers are found without
+    walking the whole graph.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.offers = {}    # offer id -> (id, userId, givesFoodId, wantsFoodId, createdAt)
+        self.giving = {}    # food id -> offer ids giving it
+        self.wanting = {}   # food id (or 'all') -> offer ids wanting it
+        self.by_user = {}   # user id -> offer ids
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_open_offer(data):
+        return bool(data) and data.get('status') == 'pending' and not data.get('isRequest')
+
+    def _unlink(self, offer_id):
+        offer = self.offers.pop(offer_id, None)
+        if offer:
+            _, user_id, gives, wants, _ = offer
+            for index, key in ((self.giving, gives), (self.wanting, wants), (self.by_user, user_id)):
+                ids = index.get(key)
+                if ids is not None:
+                    ids.discard(offer_id)
+                    if not ids:
+                        del index[key]
+
+    def upsert(self, offer_id, data):
+        with self._lock:
+            self._unlink(offer_id)
+            if not self.is_open_offer(data):
+                return
+            gives, wants = data.get('offeredFoodId'), data.get('requestedFoodId') or 'all'
+            if not gives:
+                return
+            offer = (offer_id, data.get('fromUserId'), gives, wants,
+                     as_datetime(data.get('createdAt')) or datetime.max)
+            self.offers[offer_id] = offer
+            self.giving.setdefault(gives, set()).add(offer_id)
+            self.wanting.setdefault(wants, set()).add(offer_id)
+            self.by_user.setdefault(offer[1], set()).add(offer_id)
+
+    def remove(self, offer_id):
+        with self._lock:
+            self._unlink(offer_id)
+
+    def clear(self):
+        with self._lock:
+            self.offers.clear()
+            self.giving.clear()
+            self.wanting.clear()
+            self.by_user.clear()
+            self.loaded = False
+
+    def _wanters(self, food_id, wildcard=False):
+        """Offers that would accept food_id: exact wants, or 'all' when wildcard"""
+        return self.wanting.get('all' if wildcard else food_id, ())
+
+    def _suppliers_of(self, wanted_food):
+        """Return f(food, wildcard) -> offers that give wanted_food and accept food.
+
+        Givers of the wanted food are grouped by what they want once, so each
+        lookup in the cycle search is a dict hit instead of a scan.
+        """
+        if wanted_food == 'all':
+            return self._wanters
+
+        grouped = {}
+        for offer_id in self.giving.get(wanted_food, ()):
+            grouped.setdefault(self.offers[offer_id][3], []).append(offer_id)
+        return lambda food, wildcard=False: grouped.get('all' if wildcard else food, ())
+
+    def find_cycles(self, user_id, max_length=MATCH_MAX_LENGTH, limit=20,
+                    budget=MATCH_SEARCH_BUDGET):
+        """Ranked 2- and 3-way trade cycles through this user's open offers.
+
+        Cycles are searched in ranking order - fewest 'all' offers, then
+        fewest parties - across all of the user's offers, and the search
+        stops once a whole tier has filled the limit. Each start offer has
+        its own step budget. Returns (cycles, truncated); truncated is True
+        when some offer ran out of budget, which only happens with many
+        'all' offers.
+        """
+        cycles = []
+        truncated = False
+
+        with self._lock:
+            starts = [self.offers[start_id] for start_id in self.by_user.get(user_id, ())]
+            suppliers = {start[0]: self._suppliers_of(start[3]) for start in starts}
+            steps = dict.fromkeys(suppliers, 0)
+
+            def two_way(start, b_wild):
+                # B gives what we want and wants what we give
+                for b_id in suppliers[start[0]](start[2], b_wild):
+                    steps[start[0]] += 1
+                    b = self.offers[b_id]
+                    if b[1] != user_id:
+                        cycles.append((start, b))
+                    if steps[start[0]] >= budget:
+                        return
+
+            def three_way(start, c_wild, b_wild):
+                # We receive from B, B receives from C, C receives ours
+                for c_id in self._wanters(start[2], c_wild):
+                    steps[start[0]] += 1
+                    c = self.offers[c_id]
+                    if c[1] != user_id:
+                        for b_id in suppliers[start[0]](c[2], b_wild):
+                            steps[start[0]] += 1
+                            b = self.offers[b_id]
+                            if b[1] not in (user_id, c[1]):
+                                cycles.append((start, b, c))
+                            if steps[start[0]] >= budget:
+                                return
+                    if steps[start[0]] >= budget:
+                        return
+
+            for wildcards in range(max_length + 1):
+                for length in range(2, max_length + 1):
+                    for start in starts:
+                        if steps[start[0]] >= budget:
+                            truncated = True
+                            continue
+                        # How many of the other offers may want 'all' in this tier
+                        others = wildcards - (start[3] == 'all')
+                        if length == 2 and others in (0, 1):
+                            two_way(start, others == 1)
+                        elif length == 3 and 0 <= others <= 2:
+                            for c_wild in (False, True):
+                                if 0 <= others - c_wild <= 1:
+                                    three_way(start, c_wild, others - c_wild == 1)
+                        truncated = truncated or steps[start[0]] >= budget
+                    if len(cycles) >= limit:
+                        break
+                if len(cycles) >= limit:
+                    break
+
+        def score(cycle):
+            # Prefer exact wants over 'all', then fewer parties, then older offers
+            wildcards = sum(1 for offer in cycle if offer[3] == 'all')
+            return (wildcards, len(cycle), min(offer[4] for offer in cycle))
+
+        return heapq.nsmallest(limit, cycles, key=score), truncated
+
+
+barter_graph = BarterGraph()
+
+
+def _on_transaction_change_matching(change_type, trans_id, data, initial):
+    if change_type == 'RESET':
+        barter_graph.clear()
+    elif change_type == 'CURRENT':
+        barter_graph.loaded = True
+    elif change_type == 'REMOVED':
+        barter_graph.remove(trans_id)
+    else:
+        barter_graph.upsert(trans_id, data)
+
+
+transactions_watcher = watch_collection('transactions', _on_transaction_change_matching)
+
+
+def load_barter_graph():
+    """Load open offers directly when the snapshot listener isn't running"""
+    barter_graph.clear()
+    for doc in stream_documents(db.collection('transactions').where('status', '==', 'pending')):
+        barter_graph.upsert(doc.id, doc.to_dict())
+    barter_graph.loaded = True
+
+
+def _describe_cycle(cycle):
+    participants = []
+    for i, offer in enumerate(cycle):
+        offer_id, user_id, gives, _, _ = offer
+        receives = cycle[(i + 1) % len(cycle)][2]
+        participants.append({
+            'offerId': offer_id,
+            'userId': user_id,
+            'givesFoodId': gives,
+            'givesFood': (get_food(gives) or {}).get('name'),
+            'receivesFoodId': receives,
+            'receivesFood': (get_food(receives) or {}).get('name')
+        })
+    return {'length': len(cycle), 'participants': participants}
+
+
+@app.route('/api/matches/<user_id>', methods=['GET'])
+@require_auth
+def get_matches(user_id):
+    """2- and 3-way trades that would satisfy this user's open offers
+
+    Query params: maxLength (2 or 3, default 3), limit (default 20)
+    """
+    try:
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        if get_request_user_id() != user_id and not is_admin_request():
+            return jsonify({'error': 'Forbidden'}), 403
+
+        if not barter_graph.loaded and not transactions_watcher.active:
+            load_barter_graph()
+
+        max_length = min(MATCH_MAX_LENGTH, max(2, request.args.get('maxLength', 3, type=int)))
+        limit = min(MATCH_RESULTS_MAX, max(1, request.args.get('limit', 20, type=int)))
+
+        cycles, truncated = barter_graph.find_cycles(user_id, max_length=max_length, limit=limit)
+
+        return jsonify({
+            'success': True,
+            'count': len(cycles),
+            'truncated': truncated,
+            'matches': [_describe_cycle(cycle) for cycle in cycles]
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.cli.command('bench-matching')
+@click.option('--offers', default=50000, help='Number of synthetic open offers')
+@click.option('--users', default=5000, help='Number of synthetic users')
+@click.option('--foods', default=200, help='Number of distinct foods')
+@click.option('--wildcard', default=0.1, help="Share of offers that accept 'all'")
+@click.option('--queries', default=500, help='Number of users to find matches for')
+def bench_matching_command(offers, users, foods, wildcard, queries):
+    """Benchmark building the barter graph and finding cycles"""
+    rng = random.Random(42)
+    graph = BarterGraph()
+    base = datetime(2025, 1, 1)
+
+    started = time.perf_counter()
+    for i in range(offers):
+        wants = 'all' if rng.random() < wildcard else f'food{rng.randrange(foods)}'
+        graph.upsert(f'offer{i}', {
+            'status': 'pending',
+            'fromUserId': f'user{rng.randrange(users)}',
+            'offeredFoodId': f'food{rng.randrange(foods)}',
+            'requestedFoodId': wants,
+            'createdAt': base + timedelta(minutes=i)
+        })
+    build_seconds = time.perf_counter() - started
+
+    timings = []
+    found = truncated = 0
+    for _ in range(queries):
+        user_id = f'user{rng.randrange(users)}'
+        started = time.perf_counter()
+        cycles, was_truncated = graph.find_cycles(user_id)
+        timings.append(time.perf_counter() - started)
+        found += len(cycles)
+        truncated += was_truncated
+
+    timings.sort()
+    print(f"Built graph of {len(graph.offers)} offers in {build_seconds * 1000:.0f} ms")
+    print(f"{queries} queries: mean {sum(timings) / len(timings) * 1000:.2f} ms, "
+          f"p95 {timings[int(len(timings) * 0.95)] * 1000:.2f} ms, "
+          f"max {timings[-1] * 1000:.2f} ms")
+    print(f"{found} cycles returned, {truncated} searches hit the budget")
+
+# ============================================
+# TRANSACTION ARCHIVAL
+# ============================================
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 30))
+# 'firestore' moves documents to transactions_archive; 'jsonl' writes
+# gzipped JSON lines segments to ARCHIVE_DIR on this machine
+ARCHIVE_BACKEND = os.environ.get('ARCHIVE_BACKEND', 'firestore')
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+ARCHIVE_COLLECTION = 'transactions_archive'
+ARCHIVE_BATCH_DOCS = BULK_BATCH_SIZE // 2  # each document is a copy + a delete
+ARCHIVE_PAGE_SIZE_MAX = 200
+# Statuses nothing will change any more; accepted trades also need their rating request sent
+ARCHIVE_TERMINAL_STATUSES = ('declined', 'cancelled', 'taken', 'expired')
+# Old offers and requests nobody answered are marked expired, then archived on a later run
+ARCHIVE_EXPIRE_STATUSES = ('pending', 'pending_request')
+
+_archive_lock = threading.Lock()
+
+
+def _is_old(trans, cutoff):
+    when = as_datetime(trans.get('tradeDate')) or as_datetime(trans.get('createdAt'))
+    return when is not None and when < cutoff
+
+
+def is_archivable(trans, cutoff):
+    """Finished transactions whose trade date is before the cutoff"""
+    status = trans.get('status')
+    finished = status in ARCHIVE_TERMINAL_STATUSES or (status == 'accepted' and trans.get('ratingSent'))
+    return finished and _is_old(trans, cutoff)
+
+
+def is_expirable(trans, cutoff):
+    """Open offers and requests left unanswered past the cutoff"""
+    return trans.get('status') in ARCHIVE_EXPIRE_STATUSES and _is_old(trans, cutoff)
+
+
+def _archive_checkpoint():
+    return db.collection('_meta').document('transactionArchive')
+
+
+def _write_archive_segment(docs):
+    """Write documents to a new gzipped JSONL segment, durable before returning"""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, f"transactions-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.jsonl.gz")
+    with open(path + '.tmp', 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as segment:
+            for doc in docs:
+                line = json.dumps(dict(doc.to_dict(), id=doc.id), default=json_default) + '\n'
+                segment.write(line.encode('utf-8'))
+        raw.flush()
+        os.fsync(raw.fileno())
+    # Readers only look at complete segments
+    os.replace(path + '.tmp', path)
+
+
+def _archive_batch(docs):
+    """Copy a batch of documents to the archive and delete the originals"""
+    if ARCHIVE_BACKEND == 'jsonl':
+        _write_archive_segment(docs)
+
+    batch = db.batch()
+    for doc in docs:
+        if ARCHIVE_BACKEND != 'jsonl':
+            data = doc.to_dict()
+            data['participants'] = [uid for uid in (data.get('fromUserId'), data.get('toUserId')) if uid]
+            data['archivedAt'] = datetime.now().isoformat()
+            batch.set(db.collection(ARCHIVE_COLLECTION).document(doc.id), data)
+        batch.delete(doc.reference)
+    batch.commit()
+
+
+def archive_transactions(max_docs=None):
+    """Move old transactions out of the working set.
+
+    Scans transactions in id order and saves a cursor after every committed
+    batch, so an interrupted run picks up where it stopped. Copy and delete
+    for a document happen in the same batch, so nothing is lost or doubled.
+    Stale open offers and requests are only marked expired here - the stats
+    listener sees that as a normal status change - and archived next time.
+    """
+    if not db or not _archive_lock.acquire(blocking=False):
+        return 0
+
+    try:
+        cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+        checkpoint_ref = _archive_checkpoint()
+        checkpoint = checkpoint_ref.get()
+        cursor = checkpoint.to_dict().get('cursor') if checkpoint.exists else None
+
+        archived = expired = 0
+        pending = []
+        expiring = []
+        last_id = cursor
+
+        def commit():
+            nonlocal archived, expired
+            if pending:
+                _archive_batch(pending)
+                archived += len(pending)
+                pending.clear()
+            if expiring:
+                batch = db.batch()
+                for doc in expiring:
+                    batch.update(doc.reference, {'status': 'expired', 'expiredAt': datetime.now().isoformat()})
+                batch.commit()
+                expired += len(expiring)
+                expiring.clear()
+            checkpoint_ref.set({'cursor': last_id, 'updatedAt': datetime.now().isoformat()})
+
+        for doc in stream_documents(db.collection('transactions'), start_after_id=cursor):
+            trans = doc.to_dict() or {}
+            # Left for a later run until the stats listener has counted its final state
+            if is_archivable(trans, cutoff) and is_stats_counted(trans):
+                pending.append(doc)
+            elif is_expirable(trans, cutoff):
+                expiring.append(doc)
+            last_id = doc.id
+            if len(pending) >= ARCHIVE_BATCH_DOCS or len(expiring) >= BULK_BATCH_SIZE:
+                commit()
+            if max_docs and archived + len(pending) >= max_docs:
+                commit()
+                break
+        else:
+            # Reached the end - the next run starts from the beginning again
+            last_id = None
+            commit()
+
+        metrics.incr('archive.transactions', archived)
+        metrics.incr('archive.expired', expired)
+        print(f"✅ Archived {archived} transactions, marked {expired} expired")
+        return archived
+
+    except Exception as e:
+        print(f"❌ Error archiving transactions: {e}")
+        return 0
+
+    finally:
+        _archive_lock.release()
+
+
+def iter_archived_transactions(user_id=None):
+    """Yield (id, data) for archived transactions, optionally for one user"""
+    if ARCHIVE_BACKEND == 'jsonl':
+        if not os.path.isdir(ARCHIVE_DIR):
+            return
+        for name in sorted(os.listdir(ARCHIVE_DIR)):
+            if not name.endswith('.jsonl.gz'):
+                continue
+            with gzip.open(os.path.join(ARCHIVE_DIR, name), 'rt', encoding='utf-8') as segment:
+                for line in segment:
+                    data = json.loads(line)
+                    if user_id and user_id not in (data.get('fromUserId'), data.get('toUserId')):
+                        continue
+                    yield data.pop('id'), data
+        return
+
+    query = db.collection(ARCHIVE_COLLECTION)
+    if user_id:
+        query = query.where('participants', 'array_contains', user_id)
+    for doc in stream_documents(query):
+        yield doc.id, doc.to_dict()
+
+
+def read_archived_trades(user_id, cursor, page_size):
+    """One page of a user's archived trades and the cursor for the next page.
+
+    The cursor is the last document id for Firestore and a line offset for
+    JSONL segments.
+    """
+    if ARCHIVE_BACKEND == 'jsonl':
+        offset = int(cursor or 0)
+        archived = itertools.islice(iter_archived_transactions(user_id), offset, None)
+    else:
+        query = db.collection(ARCHIVE_COLLECTION).where('participants', 'array_contains', user_id)
+        archived = ((doc.id, doc.to_dict()) for doc in
+                    stream_documents(query, page_size=page_size + 1, start_after_id=cursor))
+
+    trades = []
+    for trans_id, trans in archived:
+        if len(trades) == page_size:
+            if ARCHIVE_BACKEND == 'jsonl':
+                return trades, str(offset + page_size)
+            return trades, trades[-1]['id']
+        trans.pop('participants', None)
+        trans['id'] = trans_id
+        trans['direction'] = 'sent' if trans.get('fromUserId') == user_id else 'received'
+        trades.append(trans)
+
+    return trades, None
+
+
+@app.cli.command('archive-transactions')
+@click.option('--max-docs', default=0, help='Stop after archiving this many (0 = no limit)')
+def archive_transactions_command(max_docs):
+    """Move finished transactions older than ARCHIVE_AFTER_DAYS to the archive"""
+    if not db:
+        print("❌ Database not connected")
+        return
+    archive_transactions(max_docs=max_docs or None)
+
+# ============================================
+# NUTRITION ANALYTICS
+# ============================================
+
+NUTRIENTS = ('calories', 'protein', 'carbs', 'fat')
+# Days of trades each period covers, ending today (None = everything)
+ANALYTICS_PERIODS = {'week': 7, 'month': 30, 'term': 120, 'year': 365, 'all': None}
+ANALYTICS_CACHE_TTL = int(os.environ.get('ANALYTICS_CACHE_TTL', 600))
+ANALYTICS_TOP_FOODS = 10
+ANALYTICS_MAX_USERS = 500
+
+analytics_cache = TTLCache(maxsize=64, ttl=ANALYTICS_CACHE_TTL)
+
+
+def _nutrient_value(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _week_start(week):
+    # Ordinal day 1 (0001-01-01) was a Monday, so weeks run Monday to Sunday
+    return datetime.fromordinal(int(week) * 7 + 1).date().isoformat()
+
+
+def _group_sum(codes, values, size):
+    """Sum the rows of a 2-D array for each code in range(size)"""
+    return np.stack([np.bincount(codes, weights=values[:, i], minlength=size)
+                     for i in range(values.shape[1])], axis=1)
+
+
+def _nutrient_totals(row):
+    return {nutrient: round(float(value), 1) for nutrient, value in zip(NUTRIENTS, row)}
+
+
+class NutritionDataset:
+    """Foods and the food received in accepted trades, as NumPy columns.
+
+    An accepted trade gives the offered food to the user who made the offer
+    and, unless they asked for 'all', the requested food to the requester,
+    so each trade contributes up to two rows.
+    """
+
+    def __init__(self, foods, transactions):
+        food_index = {}
+        meal_index = {}
+        self.food_ids = []
+        self.food_names = []
+        nutrient_rows = []
+        meal_codes = []
+        for food_id, food in foods:
+            food_index[food_id] = len(self.food_ids)
+            self.food_ids.append(food_id)
+            self.food_names.append(food.get('name', ''))
+            nutrient_rows.append([_nutrient_value(food.get(nutrient)) for nutrient in NUTRIENTS])
+            meal_codes.append(meal_index.setdefault(food.get('mealType') or 'other', len(meal_index)))
+
+        self.meal_types = list(meal_index)
+        self.nutrients = np.array(nutrient_rows, dtype=np.float64).reshape(-1, len(NUTRIENTS))
+        self.food_meal = np.array(meal_codes, dtype=np.int32)
+
+        user_index = {}
+        users, items, days = [], [], []
+        for trans in transactions:
+            when = as_datetime(trans.get('tradeDate')) or as_datetime(trans.get('createdAt'))
+            if when is None:
+                continue
+            received = ((trans.get('toUserId'), trans.get('offeredFoodId')),
+                        (trans.get('fromUserId'), trans.get('requestedFoodId')))
+            for user_id, food_id in received:
+                item = food_index.get(food_id)
+                if user_id and item is not None:
+                    users.append(user_index.setdefault(user_id, len(user_index)))
+                    items.append(item)
+                    days.append(when.toordinal())
+
+        self.user_ids = list(user_index)
+        self._user_index = user_index
+        self.users = np.array(users, dtype=np.int32)
+        self.items = np.array(items, dtype=np.int32)
+        self.days = np.array(days, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _window(self, start_day):
+        if start_day is None:
+            return self.users, self.items, self.days
+        mask = self.days >= start_day
+        return self.users[mask], self.items[mask], self.days[mask]
+
+    def _weekly(self, items, days, users=None):
+        if not len(items):
+            return []
+        weeks = (days - 1) // 7
+        first_week = int(weeks.min())
+        week_codes = weeks - first_week
+        size = int(week_codes.max()) + 1
+        totals = _group_sum(week_codes, self.nutrients[items], size)
+        counts = np.bincount(week_codes, minlength=size)
+        if users is not None:
+            # Distinct users per week from a week x user presence grid
+            seen = np.zeros((size, len(self.user_ids)), dtype=bool)
+            seen[week_codes, users] = True
+            active = seen.sum(axis=1)
+
+        weekly = []
+        for i in np.flatnonzero(counts):
+            entry = {'weekStart': _week_start(first_week + i), 'items': int(counts[i]),
+                     'totals': _nutrient_totals(totals[i])}
+            if users is not None:
+                entry['activeUsers'] = int(active[i])
+            weekly.append(entry)
+        return weekly
+
+    def _meal_types(self, items):
+        meals = self.food_meal[items]
+        counts = np.bincount(meals, minlength=len(self.meal_types))
+        calories = np.bincount(meals, weights=self.nutrients[items, 0], minlength=len(self.meal_types))
+        total = max(int(counts.sum()), 1)
+        return {meal: {'items': int(counts[i]), 'share': round(counts[i] / total, 3),
+                       'calories': round(float(calories[i]), 1)}
+                for i, meal in enumerate(self.meal_types) if counts[i]}
+
+    def _top_foods(self, items, top):
+        counts = np.bincount(items, minlength=len(self.food_ids))
+        ranked = np.argsort(-counts, kind='stable')[:top]
+        return [{'foodId': self.food_ids[i], 'name': self.food_names[i], 'trades': int(counts[i])}
+                for i in ranked if counts[i]]
+
+    def report(self, start_day=None, top=ANALYTICS_TOP_FOODS):
+        """School-wide intake by user and week, meal types and top foods"""
+        users, items, days = self._window(start_day)
+        intake = self.nutrients[items]
+
+        user_totals = _group_sum(users, intake, len(self.user_ids))
+        user_counts = np.bincount(users, minlength=len(self.user_ids))
+        active = np.flatnonzero(user_counts)
+        ranked = active[np.argsort(-user_totals[active, 0], kind='stable')][:ANALYTICS_MAX_USERS]
+
+        return {
+            'items': int(len(items)),
+            'userCount': int(len(active)),
+            'totals': _nutrient_totals(intake.sum(axis=0)),
+            'perUser': [{'userId': self.user_ids[i], 'items': int(user_counts[i]),
+                         'totals': _nutrient_totals(user_totals[i])} for i in ranked],
+            'perWeek': self._weekly(items, days, users),
+            'mealTypes': self._meal_types(items),
+            'topFoods': self._top_foods(items, top)
+        }
+
+    def user_report(self, user_id, start_day=None, top=ANALYTICS_TOP_FOODS):
+        """One user's intake by week, meal types and most received foods"""
+        users, items, days = self._window(start_day)
+        code = self._user_index.get(user_id)
+        mask = users == (code if code is not None else -1)
+        items, days = items[mask], days[mask]
+
+        return {
+            'userId': user_id,
+            'items': int(len(items)),
+            'totals': _nutrient_totals(self.nutrients[items].sum(axis=0)),
+            'perWeek': self._weekly(items, days),
+            'mealTypes': self._meal_types(items),
+            'topFoods': self._top_foods(items, top)
+        }
+
+
+def load_nutrition_dataset():
+    """Accepted trades (live and archived) and foods, cached for ANALYTICS_CACHE_TTL"""
+    dataset = analytics_cache.get('dataset')
+    if dataset is None:
+        started = time.perf_counter()
+        foods = ((doc.id, doc.to_dict()) for doc in stream_documents(db.collection('foods')))
+        accepted = db.collection('transactions').where('status', '==', 'accepted')
+        transactions = itertools.chain(
+            (doc.to_dict() for doc in stream_documents(accepted)),
+            (trans for _, trans in iter_archived_transactions() if trans.get('status') == 'accepted'))
+        dataset = NutritionDataset(foods, transactions)
+        analytics_cache.set('dataset', dataset)
+        print(f"📊 Loaded {len(dataset)} traded items for analytics in "
+              f"{(time.perf_counter() - started) * 1000:.0f} ms")
+    return dataset
+
+
+@app.route('/api/analytics/nutrition', methods=['GET'])
+def nutrition_analytics():
+    """Nutrient intake from accepted trades
+
+    Query params: period (week, month, term, year or all; default month)
+    and userId for one user's breakdown. Without userId the school-wide
+    report is returned, which is admin only.
+    """
+    try:
+        if not NUMPY_AVAILABLE:
+            return jsonify({'error': 'Analytics unavailable (NumPy not installed)'}), 503
+        if not db:
+            return jsonify({'error': 'Database not connected'}), 500
+
+        period = request.args.get('period', 'month')
+        if period not in ANALYTICS_PERIODS:
+            return jsonify({'error': f"period must be one of {', '.join(ANALYTICS_PERIODS)}"}), 400
+
+        user_id = request.args.get('userId')
+        if not is_admin_request() and (not user_id or user_id != get_request_user_id()):
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        today = datetime.utcnow().toordinal()
+        cache_key = (period, user_id, today)
+        result = analytics_cache.get(cache_key)
+        if result is None:
+            days = ANALYTICS_PERIODS[period]
+            start_day = today - days + 1 if days else None
+            dataset = load_nutrition_dataset()
+            if user_id:
+                result = dataset.user_report(user_id, start_day)
+            else:
+                result = dataset.report(start_day)
+            result['period'] = period
+            analytics_cache.set(cache_key, result)
+
+        return jsonify(dict(result, success=True))
+
+    except Exception as e:
+        print(f"❌ Error computing nutrition analytics: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.cli.command('bench-analytics')
+@click.option('--trades', default=100000, help='Number of synthetic accepted trades')
+@click.option('--users', default=3000, help='Number of synthetic users')
+@click.option('--foods', default=200, help='Number of distinct foods')
+def bench_analytics_command(trades, users, foods):
+    """Benchmark the nutrition analytics over a year of synthetic trades"""
+    if not NUMPY_AVAILABLE:
+        print("❌ NumPy not installed")
+        return
+
+    rng = random.Random(42)
+    meal_types = ('breakfast', 'lunch', 'dinner', 'snack')
+    food_docs = [(f'food{i}', {'name': f'Food {i}', 'mealType': rng.choice(meal_types),
+                               'calories': rng.randrange(100, 900), 'protein': rng.randrange(0, 40),
+                               'carbs': rng.randrange(0, 100), 'fat': rng.randrange(0, 40)})
+                 for i in range(foods)]
+    base = datetime.utcnow() - timedelta(days=365)
+    trade_docs = [{'fromUserId': f'user{rng.randrange(users)}', 'toUserId': f'user{rng.randrange(users)}',
+                   'offeredFoodId': f'food{rng.randrange(foods)}',
+                   'requestedFoodId': 'all' if rng.random() < 0.2 else f'food{rng.randrange(foods)}',
+                   'tradeDate': (base + timedelta(days=rng.randrange(366))).date().isoformat()}
+                  for _ in range(trades)]
+
+    started = time.perf_counter()
+    dataset = NutritionDataset(food_docs, trade_docs)
+    load_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    report = dataset.report()
+    report_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for i in range(100):
+        dataset.user_report(f'user{i}')
+    user_seconds = (time.perf_counter() - started) / 100
+
+    print(f"Loaded {len(dataset)} items from {trades} trades in {load_seconds * 1000:.0f} ms")
+    print(f"School-wide report in {report_seconds * 1000:.1f} ms "
+          f"({report['userCount']} users, {len(report['perWeek'])} weeks)")
+    print(f"Per-user report in {user_seconds * 1000:.2f} ms")
+
+# ============================================
+# BACKGROUND LISTENERS
+# ============================================
+if db:
+    start_collection_watchers()
+
+if scheduler:
+    scheduler.add_job(check_collection_watchers, 'interval', minutes=1)
+    scheduler.add_job(update_replica_gauges, 'interval', minutes=1)
+    scheduler.add_job(sync_people_index, 'interval', minutes=PEOPLE_INDEX_SYNC_MINUTES)
+    scheduler.add_job(user_stats.flush, 'interval', seconds=USER_STATS_FLUSH_SECONDS)
+    scheduler.add_job(archive_transactions, 'cron', hour=3, timezone=timezone)
+
 # ============================================
 # START THE SERVER
 # ============================================
@@ -978,21 +4287,37 @@ if __name__ == '__main__':
     print("\n📋 EMAIL ENDPOINTS:")
     print("  GET  /api/test-email           - Test email system")
     print("  POST /api/send_welcome_email   - Welcome email")
-    print("  POST /api/send_trade_request   - Trade request notification")
-    print("  POST /api/send_trade_accepted  - Trade acceptance notification")
+    print("  POST /api/send_trade_request   - Trade request notification (transaction_id)")
+    print("  POST /api/send_trade_accepted  - Trade acceptance notification (transaction_id)")
+    print("  POST /api/send_trade_declined  - Trade declined notification (transaction_id)")
+    print("  POST /api/notify               - Trade event notification (event + transaction_id)")
     print("\n📋 ADMIN ENDPOINTS:")
     print("  GET    /api/admin/foods        - Get all foods (admin only)")
     print("  POST   /api/admin/foods        - Add new food (admin only)")
     print("  PUT    /api/admin/foods        - Update food (admin only)")
     print("  DELETE /api/admin/foods        - Delete food (admin only)")
+    print("  POST   /api/admin/foods/bulk   - Bulk import foods from CSV/JSON (admin only)")
     print("  GET    /api/admin/check        - Check if user is admin")
+    print("  GET    /api/admin/export/<col> - Stream foods/transactions/ratings as NDJSON or CSV")
+    print("  POST   /api/admin/announce     - Email an announcement to all users (background job)")
+    print("  GET    /api/admin/announce/<id> - Announcement progress")
+    print("  POST   /api/admin/announce/<id>/resume - Resume an interrupted announcement")
     print("\n📋 DATA ENDPOINTS:")
     print("  GET  /api/foods                - Get all foods")
     print("  GET  /api/trade-history/<id>   - Get user trade history")
+    print("  GET  /api/trade-history/<id>?archived=true - Archived trades, paged")
+    print("  GET  /api/metrics              - Counters and gauges (admin only)")
+    print("  GET  /api/people/search        - Search the people directory")
+    print("  GET  /api/users/resolve        - Resolve a username for login")
+    print("  POST /api/users/resolve        - Resolve many usernames/ids at once")
+    print("  GET  /api/users/<id>/stats     - Trade and rating counters for a user")
+    print("  GET  /api/matches/<id>         - 2- and 3-way trade matches for a user")
+    print("  GET  /api/analytics/nutrition  - Nutrient intake from trades, by user and week")
     print("  POST /api/init_foods           - Initialize sample data")
     print("\n⏰ SCHEDULED TASKS:")
     print("  Trade reminders - Every 5 minutes")
     print("  Rating requests - Every 5 minutes")
+    print("  Transaction archival - Daily at 03:00")
     print("="*60)
     print("🔄 Starting server... (Press Ctrl+C to stop)")
     print("="*60 + "\n")
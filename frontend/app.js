@@ -35,6 +35,38 @@ const sampleFoods = [
     }
 ];
 
+// ============================================
+// API HELPERS
+// ============================================
+
+// Authorization header carrying the signed-in user's Firebase ID token.
+// getIdToken() reuses the cached token until it is about to expire.
+async function getAuthHeader() {
+    const user = auth.currentUser;
+    if (!user) return '';
+    return 'Bearer ' + await user.getIdToken();
+}
+
+// Whether a username is already taken (the signup availability check)
+async function usernameExists(username) {
+    const response = await fetch(`https://ict-dh-commerce-project.onrender.com/api/users/resolve?username=${encodeURIComponent(username)}`);
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error || 'Username lookup failed');
+    return data.exists;
+}
+
+// Username sign-in and resets happen on the server so emails are never exposed
+async function postAuth(path, body) {
+    const response = await fetch(`https://ict-dh-commerce-project.onrender.com/api/auth/${path}`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(body)
+    });
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error || 'Request failed');
+    return data;
+}
+
 // ============================================
 // INITIALIZATION - RUNS WHEN PAGE LOADS
 // ============================================
@@ -285,25 +317,16 @@ async function handleSignIn(e) {
     }
 
     try {
-        // Check if it's email format, if not, get email from database
-        let email = username;
-        if (!username.includes('@')) {
-            // Try to find user by username
-            const usersSnapshot = await db.collection('users')
-                .where('username', '==', username)
-                .limit(1)
-                .get();
-
-            if (!usersSnapshot.empty) {
-                const userData = usersSnapshot.docs[0].data();
-                email = userData.email;
-            }
+        let userCredential;
+        if (username.includes('@')) {
+            console.log("Calling auth.signInWithEmailAndPassword...");
+            userCredential = await auth.signInWithEmailAndPassword(username, password);
+        } else {
+            // Usernames are checked by the server, which returns a sign-in token
+            console.log("Signing in with username...");
+            const data = await postAuth('login', { username, password });
+            userCredential = await auth.signInWithCustomToken(data.token);
         }
-
-        console.log("Attempting sign in with email:", email);
-
-        console.log("Calling auth.signInWithEmailAndPassword...");
-        const userCredential = await auth.signInWithEmailAndPassword(email, password);
         console.log("SUCCESS! User signed in:", userCredential.user.uid);
 
         showToast('Signed in successfully!', 'success');
@@ -347,6 +370,12 @@ async function handleSignUp(e) {
     }
 
     try {
+        // Usernames are used to sign in, so they must be unique
+        if (await usernameExists(username)) {
+            showToast('That username is already taken', 'error');
+            return;
+        }
+
         // Create auth user
         const userCredential = await auth.createUserWithEmailAndPassword(email, password);
         const userId = userCredential.user.uid;
@@ -373,6 +402,7 @@ async function handleSignUp(e) {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Authorization': await getAuthHeader()
                 },
                 body: JSON.stringify({
                     email: email,
@@ -416,22 +446,12 @@ async function handleForgotPassword() {
     if (!username) return;
 
     try {
-        let email = username;
-
-        // Check if it's a username
-        if (!username.includes('@')) {
-            const usersSnapshot = await db.collection('users')
-                .where('username', '==', username)
-                .limit(1)
-                .get();
-
-            if (!usersSnapshot.empty) {
-                const userData = usersSnapshot.docs[0].data();
-                email = userData.email;
-            }
+        if (username.includes('@')) {
+            await auth.sendPasswordResetEmail(username);
+        } else {
+            // The server looks up the email and sends the link itself
+            await postAuth('password-reset', { username });
         }
-
-        await auth.sendPasswordResetEmail(email);
         showToast('Password reset email sent! Check your inbox.', 'success');
     } catch (error) {
         showToast('Error: Email/Username not found', 'error');
@@ -638,32 +658,34 @@ function formatDate(date) {
 // ============================================
 // PEOPLE PAGE FUNCTIONS
 // ============================================
-async function loadPeople(searchTerm = '') {
+async function loadPeople(searchTerm = '', page = 1) {
     try {
-        const snapshot = await db.collection('users').get();
-        const peopleGrid = document.getElementById('people-grid');
-        peopleGrid.innerHTML = '';
-
-        let hasResults = false;
-
-        snapshot.forEach(doc => {
-            const user = doc.data();
-            if (doc.id === currentUserId) return;
-
-            // Apply search filter
-            if (searchTerm &&
-                !user.fullName.toLowerCase().includes(searchTerm.toLowerCase()) &&
-                !user.username.toLowerCase().includes(searchTerm.toLowerCase())) {
-                return;
+        const params = new URLSearchParams({
+            q: searchTerm,
+            page: page,
+            pageSize: 30,
+            exclude: currentUserId || ''
+        });
+        const response = await fetch(`https://ict-dh-commerce-project.onrender.com/api/people/search?${params}`, {
+            headers: {
+                'Authorization': await getAuthHeader()
             }
+        });
+        const data = await response.json();
+        if (!data.success) throw new Error(data.error || 'Search failed');
+
+        const peopleGrid = document.getElementById('people-grid');
+        if (page === 1) peopleGrid.innerHTML = '';
 
-            hasResults = true;
+        const loadMoreBtn = document.getElementById('people-load-more');
+        if (loadMoreBtn) loadMoreBtn.remove();
 
+        data.people.forEach(user => {
             const avgRating = user.ratingCount > 0 ?
                 (user.totalRating / user.ratingCount).toFixed(1) : 'No ratings';
 
             const userCard = `
-                <div class="user-card" data-userid="${doc.id}">
+                <div class="user-card" data-userid="${user.id}">
                     <div class="user-avatar">
                         <i class="fas fa-user"></i>
                     </div>
@@ -683,7 +705,7 @@ async function loadPeople(searchTerm = '') {
             peopleGrid.innerHTML += userCard;
         });
 
-        if (!hasResults) {
+        if (data.total === 0) {
             peopleGrid.innerHTML = `
                 <div class="no-results">
                     <i class="fas fa-search fa-3x"></i>
@@ -691,6 +713,13 @@ async function loadPeople(searchTerm = '') {
                     <p>Try a different search term</p>
                 </div>
             `;
+        } else if (data.hasMore) {
+            peopleGrid.insertAdjacentHTML('beforeend', `
+                <button id="people-load-more" class="btn-secondary">Load more</button>
+            `);
+            document.getElementById('people-load-more').addEventListener('click', function () {
+                loadPeople(searchTerm, page + 1);
+            });
         }
     } catch (error) {
         console.error('Error loading people:', error);
@@ -1044,12 +1073,8 @@ async function sendTradeRequest() {
         const currentUserDoc = await db.collection('users').doc(currentUserId).get();
         const currentUserData = currentUserDoc.data();
 
-        // Get seller info for email
-        const sellerDoc = await db.collection('users').doc(sellerId).get();
-        const sellerData = sellerDoc.data();
-
         // Create the trade request
-        await db.collection('transactions').add({
+        const requestRef = await db.collection('transactions').add({
             fromUserId: currentUserId,
             toUserId: sellerId,
             offeredFoodId: foodId,
@@ -1077,19 +1102,15 @@ async function sendTradeRequest() {
 
         // Send email notification
         try {
-            await fetch('https://ict-dh-commerce-project.onrender.com/api/send_trade_request', {
+            await fetch('https://ict-dh-commerce-project.onrender.com/api/notify', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Authorization': await getAuthHeader()
                 },
                 body: JSON.stringify({
-                    to_email: sellerData.email,
-                    from_user: currentUserData.fullName,
-                    food_name: originalFood.name,
-                    offer_food: offeredFood.name,
-                    trade_time: originalOffer.tradeTime,
-                    trade_date: originalOffer.tradeDate,
-                    app_url: window.location.origin
+                    event: 'trade_request',
+                    transaction_id: requestRef.id
                 })
             });
         } catch (emailError) {
@@ -1395,26 +1416,17 @@ async function acceptTradeRequest(requestId) {
             createdAt: firebase.firestore.FieldValue.serverTimestamp()
         });
 
-        // Send acceptance email
+        // Send acceptance email (the server looks up the buyer and food)
         try {
-            const buyerDoc = await db.collection('users').doc(request.fromUserId).get();
-            const buyerData = buyerDoc.data();
-
-            const requestedFoodDoc = await db.collection('foods').doc(request.requestedFoodId).get();
-            const requestedFood = requestedFoodDoc.data();
-
-            await fetch('https://ict-dh-commerce-project.onrender.com/api/send_trade_accepted', {
+            await fetch('https://ict-dh-commerce-project.onrender.com/api/notify', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Authorization': await getAuthHeader()
                 },
                 body: JSON.stringify({
-                    to_email: buyerData.email,
-                    from_user: currentUserData.fullName,
-                    food_name: requestedFood.name,
-                    trade_time: request.tradeTime,
-                    trade_date: request.tradeDate,
-                    app_url: window.location.origin
+                    event: 'trade_accepted',
+                    transaction_id: requestId
                 })
             });
         } catch (emailError) {
@@ -1460,21 +1472,17 @@ async function declineTradeRequest(requestId) {
             createdAt: firebase.firestore.FieldValue.serverTimestamp()
         });
 
-        // Send decline email with reason
+        // Send decline email (the server reads the reason from the request)
         try {
-            const buyerDoc = await db.collection('users').doc(request.fromUserId).get();
-            const buyerData = buyerDoc.data();
-
-            await fetch('https://ict-dh-commerce-project.onrender.com/api/send_trade_declined', {
+            await fetch('https://ict-dh-commerce-project.onrender.com/api/notify', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Authorization': await getAuthHeader()
                 },
                 body: JSON.stringify({
-                    to_email: buyerData.email,
-                    from_user: currentUserData.fullName,
-                    reason: reason || 'No reason provided',
-                    app_url: window.location.origin
+                    event: 'trade_declined',
+                    transaction_id: requestId
                 })
             });
         } catch (emailError) {
@@ -1652,6 +1660,21 @@ async function loadUserProfile(userId) {
             // Update stars
             updateStars('.profile-card .stars', avgRating);
             updateCharCount();
+
+            // Completed trades are counted by the backend
+            try {
+                const response = await fetch(`https://ict-dh-commerce-project.onrender.com/api/users/${userId}/stats`, {
+                    headers: {
+                        'Authorization': await getAuthHeader()
+                    }
+                });
+                const data = await response.json();
+                if (data.success) {
+                    document.getElementById('trades-count').textContent = data.stats.tradesCompleted;
+                }
+            } catch (statsError) {
+                console.log('Trade stats unavailable (backend might be offline)');
+            }
         }
     } catch (error) {
         console.error('Error loading profile:', error);
@@ -1660,7 +1683,11 @@ async function loadUserProfile(userId) {
 
 async function loadTradeHistory() {
     try {
-        const response = await fetch(`https://ict-dh-commerce-project.onrender.com/api/trade-history/${currentUserId}`);
+        const response = await fetch(`https://ict-dh-commerce-project.onrender.com/api/trade-history/${currentUserId}`, {
+            headers: {
+                'Authorization': await getAuthHeader()
+            }
+        });
         const data = await response.json();
 
         const historyList = document.getElementById('trade-history');
@@ -1800,7 +1827,7 @@ async function loadAdminFoods() {
     try {
         const response = await fetch('https://ict-dh-commerce-project.onrender.com/api/admin/foods', {
             headers: {
-                'Authorization': 'admin-secret-key'
+                'Authorization': await getAuthHeader()
             }
         });
         const data = await response.json();
@@ -1901,7 +1928,7 @@ async function filterAdminFoods(searchTerm = '', mealType = '') {
     try {
         const response = await fetch('https://ict-dh-commerce-project.onrender.com/api/admin/foods', {
             headers: {
-                'Authorization': 'admin-secret-key'
+                'Authorization': await getAuthHeader()
             }
         });
         const data = await response.json();
@@ -1984,7 +2011,7 @@ async function editFood(foodId) {
         // First, get the food data
         const response = await fetch('https://ict-dh-commerce-project.onrender.com/api/admin/foods', {
             headers: {
-                'Authorization': 'admin-secret-key'
+                'Authorization': await getAuthHeader()
             }
         });
         const data = await response.json();
@@ -2122,7 +2149,7 @@ async function handleUpdateFood(e) {
             method: 'PUT',
             headers: {
                 'Content-Type': 'application/json',
-                'Authorization': 'admin-secret-key'
+                'Authorization': await getAuthHeader()
             },
             body: JSON.stringify({
                 id: foodId,
@@ -2153,7 +2180,7 @@ async function deleteFood(foodId) {
                 method: 'DELETE',
                 headers: {
                     'Content-Type': 'application/json',
-                    'Authorization': 'admin-secret-key'
+                    'Authorization': await getAuthHeader()
                 },
                 body: JSON.stringify({ id: foodId })
             });
@@ -2292,7 +2319,7 @@ async function handleAddFood(e) {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
-                'Authorization': 'admin-secret-key'
+                'Authorization': await getAuthHeader()
             },
             body: JSON.stringify(foodData)
         });